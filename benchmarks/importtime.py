@@ -0,0 +1,76 @@
+import re, sys, argparse, subprocess
+from pathlib import Path
+
+# Measures the start-up time of the command line tool with `python -X importtime`,
+# failing when the plain (non-interactive) mode imports rich, or when importing
+# everything it needs takes longer than the given budget. Each run is repeated a few
+# times and the fastest one is kept, to reduce the noise of a busy machine
+
+ENTRY_POINT = Path(__file__).resolve().parent.parent / "etf4u"
+LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+# modules which must not be imported by the plain mode
+DEFERRED = ["rich", "asyncio", "concurrent.futures.process"]
+
+
+def measure(args):
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", str(ENTRY_POINT), *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    imports, top_level = {}, {}
+    for line in process.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            self_time, cumulative, indent, module = match.groups()
+            imports[module] = int(cumulative)
+            # top-level imports include the time of all the modules they imported, the
+            # site module being imported by the interpreter before running anything
+            if len(indent) == 1 and module != "site":
+                top_level[module] = int(cumulative)
+    return sum(top_level.values()), imports, top_level
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Checks the import time of the etf4u command line tool"
+    )
+    argparser.add_argument(
+        "--budget",
+        type=float,
+        default=100,
+        help="Maximum import time of the plain mode, in milliseconds (default: 100)",
+    )
+    argparser.add_argument(
+        "--runs", type=int, default=5, help="Number of runs (default: 5)"
+    )
+    argparser.add_argument(
+        "--top", type=int, default=10, help="Number of slowest imports to list"
+    )
+    args = argparser.parse_args()
+
+    total, imports, top_level = min(
+        (measure(["--plain", "--help"]) for _ in range(args.runs)),
+        key=lambda run: run[0],
+    )
+    print(f"Plain mode imports: {total / 1000:.1f}ms")
+    slowest = sorted(top_level.items(), key=lambda item: item[1], reverse=True)
+    for module, cumulative in slowest[: args.top]:
+        print(f"  {cumulative / 1000:8.1f}ms  {module}")
+
+    failures = [
+        f"{module} is imported by the plain mode"
+        for module in imports
+        if any(module == name or module.startswith(f"{name}.") for name in DEFERRED)
+    ]
+    if total > args.budget * 1000:
+        failures.append(f"importing took longer than {args.budget:.0f}ms")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import sys, time, random, argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "etf4u"))
+
+import blend as blend_module
+from blend import IncrementalBlend, blend
+
+# Checks that IncrementalBlend gives the same portfolio as blend() over the current
+# holdings of its funds, through random sequences of funds being added, updated (in
+# place, reusing the same dictionary, or not) and removed. Weights are drawn from a
+# few values so that many of them tie, which is where the order the tickers are merged
+# in shows, in the order of the result as well as in the holdings kept by `clamp`. Each
+# trial either moves the changed tickers in place or sorts all of them again on every
+# update. The timing check then refreshes a large blend after updating one of its
+# small funds, which has to be faster than blending all of the funds again
+
+TIMING_FUNDS = 20
+TIMING_HOLDINGS = 20000
+TIMING_UPDATED_HOLDINGS = 50
+
+TICKERS = [f"T{i}" for i in range(60)]
+WEIGHTS = [0.5, 1.0, 1.5, 2.0, 2.5, 5.0]
+
+
+def random_holdings(rng):
+    tickers = rng.sample(TICKERS, rng.randint(1, 30))
+    return {ticker: rng.choice(WEIGHTS) for ticker in tickers}
+
+
+def trial(rng, steps):
+    options = {
+        "clamp": rng.choice([0, 5, 20]),
+        "minimum": rng.choice([0.0, 0.0, 1.0]),
+        "exclusion_list": frozenset(rng.sample(TICKERS, rng.randint(0, 5))),
+    }
+    if rng.random() < 0.3:
+        options["inclusion_list"] = frozenset(rng.sample(TICKERS, 40))
+    blend_module.RESORT_RATIO = rng.choice([0, float("inf")])
+    incremental = IncrementalBlend(**options)
+    funds = {}
+    for _ in range(steps):
+        action = rng.random()
+        if funds and action < 0.2:
+            fund = rng.choice(list(funds))
+            incremental.remove(fund)
+            del funds[fund]
+        elif funds and action < 0.4:
+            # the caller changes the holdings it passed before, and passes them again
+            fund = rng.choice(list(funds))
+            holdings = funds[fund]
+            for ticker in rng.sample(list(holdings), rng.randint(0, len(holdings))):
+                del holdings[ticker]
+            holdings.update(random_holdings(rng))
+            incremental.update(fund, holdings)
+        else:
+            fund = rng.choice("ABCDEFGH")
+            funds[fund] = random_holdings(rng)
+            incremental.update(fund, dict(funds[fund]))
+        expected = blend(list(funds.values()), **options)
+        result = incremental.portfolio()
+        if list(result.items()) != list(expected.items()):
+            return options, list(funds), result, expected
+    return None
+
+
+def best_time(fn, runs=3):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def timing(rng, clamp=0):
+    universe = [f"T{i}" for i in range(TIMING_FUNDS * TIMING_HOLDINGS // 2)]
+    funds = {
+        f"F{i}": {
+            ticker: rng.choice(WEIGHTS)
+            for ticker in rng.sample(universe, TIMING_HOLDINGS)
+        }
+        for i in range(TIMING_FUNDS)
+    }
+    funds["SMALL"] = {}
+    incremental = IncrementalBlend(clamp=clamp)
+    for fund, holdings in funds.items():
+        incremental.update(fund, holdings)
+
+    def refresh():
+        funds["SMALL"] = {
+            ticker: rng.choice(WEIGHTS)
+            for ticker in rng.sample(universe, TIMING_UPDATED_HOLDINGS)
+        }
+        incremental.update("SMALL", funds["SMALL"])
+        return incremental.portfolio()
+
+    refresh_time, result = best_time(refresh)
+    blend_time, expected = best_time(lambda: blend(list(funds.values()), clamp=clamp))
+    matched = list(result.items()) == list(expected.items())
+    print(
+        f"clamp={clamp}: refresh {refresh_time:.3f}s, blend() {blend_time:.3f}s"
+        f"{'' if matched else ' (DIFFERENT RESULTS)'}"
+    )
+    return matched and refresh_time < blend_time
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Checks that IncrementalBlend gives the same results as blend()"
+    )
+    argparser.add_argument(
+        "--trials", type=int, default=300, help="Number of trials (default: 300)"
+    )
+    argparser.add_argument(
+        "--steps", type=int, default=20, help="Updates per trial (default: 20)"
+    )
+    argparser.add_argument("--seed", type=int, default=0, help="Random seed")
+    argparser.add_argument(
+        "--no-timing", action="store_true", help="Skip the timing check"
+    )
+    args = argparser.parse_args()
+
+    rng = random.Random(args.seed)
+    failures = 0
+    resort_ratio = blend_module.RESORT_RATIO
+    for i in range(args.trials):
+        failure = trial(rng, args.steps)
+        if failure:
+            failures += 1
+            options, funds, result, expected = failure
+            print(f"FAILED: trial #{i + 1} with {options} over funds {funds}")
+            print(f"  incremental: {list(result.items())[:10]}")
+            print(f"  blend:       {list(expected.items())[:10]}")
+    print(f"{args.trials - failures}/{args.trials} trials matched blend()")
+    blend_module.RESORT_RATIO = resort_ratio
+    if not args.no_timing:
+        print(
+            f"Refreshing {TIMING_FUNDS} funds of {TIMING_HOLDINGS} holdings after "
+            f"updating one of {TIMING_UPDATED_HOLDINGS}:"
+        )
+        for clamp in (0, 100):
+            if not timing(rng, clamp):
+                failures += 1
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
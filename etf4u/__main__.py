@@ -1,45 +1,93 @@
 import os
 import sys
+import builtins
+import time
 import logging
 import argparse
-import csv
-import operator
-import pkgutil
 
-from datetime import datetime
-from pathlib import Path
-from rich import print
-from rich.logging import RichHandler
-from rich.traceback import install as install_rich_tracebacks
+from datetime import timedelta
 
-log = logging.getLogger(__name__)
-install_rich_tracebacks()
+from batch import run_batch
+from blend import blend
+from breakdown import DIMENSIONS, breakdown, build_metadata
+from cache import is_degraded, reparse
+from funds import fetch_funds, find_adapter
+from lookthrough import fetch_graph, graph_funds, look_through
+from output import FORMATS, export, export_breakdown, get_breakdown_file, top
+from results import get_result_key, load_result, store_result
+from tickers import load_index
+from watchlists import load_tickers
 
-import adapters
+log = logging.getLogger(f"etf4u.{__name__}")
 
 
-def combine_dicts(a, b, op=operator.add):
-    return {**a, **b, **{k: op(float(a[k]), float(b[k])) for k in a.keys() & b}}
+def fetch_holdings(args, **options):
+    # the holdings of the funds, and the funds whose records describe them: with
+    # --look-through, every fund of the graph fetched
+    if args.look_through:
+        graph = fetch_graph(
+            args.funds,
+            lambda funds: fetch_funds(
+                funds, no_cache=args.no_cache, use_async=args.use_async, **options
+            ),
+            args.max_depth,
+        )
+        holdings = look_through(args.funds, graph, args.max_depth)
+        return holdings, graph_funds(args.funds, graph)
+    holdings = fetch_funds(
+        args.funds,
+        no_cache=args.no_cache,
+        workers=args.workers if args.overlap else 1,
+        use_async=args.use_async,
+        **options,
+    )
+    return holdings, args.funds
 
 
-def query(fund, fetch_method):
-    now = datetime.now()
-    cached_file = Path(".cache") / f"{fund.upper()}_{now.strftime('%Y%m%d')}.csv"
-    if cached_file.is_file():
-        log.debug(f"Using data from cached file: {cached_file}")
-        with open(cached_file, "r") as csv_file:
-            reader = csv.reader(csv_file)
-            return {rows[0]: float(rows[1]) for rows in reader}
+def run_queue(args):
+    from registry import registry
+    from workqueue import open_queue, report_progress, run_workers
+
+    queue = open_queue(args.queue)
+    if args.enqueue:
+        funds = args.funds or [fund for adapter in registry for fund in adapter.funds]
+        log.info(f"Adding {len(funds)} funds to the queue")
+        queue.put(funds)
+    if args.work:
+        run_workers(queue, args.workers, args.lease)
     else:
-        data = fetch_method(fund)
-        if data:
-            cached_file.parent.mkdir(parents=True, exist_ok=True)
-            with open(cached_file, "w") as csv_file:
-                log.debug(f"Caching data to file: {cached_file}")
-                writer = csv.writer(csv_file, delimiter=",", lineterminator="\n")
-                for holding, weight in data.items():
-                    writer.writerow([holding, weight])
-        return data
+        report_progress(queue)
+
+
+def setup_output(args):
+    # configure logging for the application, returning the function printing results.
+    # rich (and its tracebacks) take longer to import than the rest of the tool, so
+    # they are only loaded for the pretty output of interactive runs
+    log = logging.getLogger("etf4u")
+    log.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    if args.quiet:
+        log.setLevel(logging.WARNING)
+    log.propagate = False
+
+    if args.plain or not sys.stdout.isatty():
+        handler = logging.StreamHandler()
+        handler.setFormatter(
+            logging.Formatter(
+                fmt="[%(asctime)s] %(levelname)-8s %(message)s", datefmt="%X"
+            )
+        )
+        log.addHandler(handler)
+        return builtins.print
+
+    from rich import print
+    from rich.logging import RichHandler
+    from rich.traceback import install as install_rich_tracebacks
+
+    install_rich_tracebacks()
+    rich_handler = RichHandler()
+    rich_handler.setFormatter(logging.Formatter(fmt="%(message)s", datefmt="[%X]"))
+    log.addHandler(rich_handler)
+    return print
 
 
 def main():
@@ -49,7 +97,7 @@ def main():
     )
     argparser.add_argument(
         "funds",
-        nargs="+",
+        nargs="*",
         default=[],
         help="A list of ETF symbols (or a single one) to scrape",
     )
@@ -81,120 +129,306 @@ def main():
         "Pass the tickers directly to the argument (e.g. --include AAA BBB CCC) "
         "Or pass the path to a text file containing the tickers",
     )
+    argparser.add_argument(
+        "--allocation",
+        nargs="+",
+        type=float,
+        help="Weight of every fund in the blend, in the same order as the funds "
+        "(e.g. VTI IXUS ARKK --allocation 60 30 10), scaling the holdings of each "
+        "fund to its share of the blend instead of adding them up (requires numpy "
+        "and scipy)",
+    )
+    argparser.add_argument(
+        "--sweep",
+        help="Evaluate every allocation of the funds listed in this .csv file (a "
+        "header of fund symbols and a row of weights per allocation) at once instead "
+        "of blending them, exporting the summary of each one to the --out-file "
+        "(requires numpy and scipy)",
+    )
     argparser.add_argument(
         "--out-file",
         help="Exports the holdings list to this comma-separated (.csv) file",
     )
+    argparser.add_argument(
+        "--out-format",
+        choices=FORMATS,
+        help="Format of the exported file, guessed from the --out-file extension "
+        "if not specified (Parquet and Arrow files require pyarrow)",
+    )
+    argparser.add_argument(
+        "--print-top",
+        type=int,
+        help="Only print the given amount of largest holdings to the terminal "
+        "(0 to skip printing the portfolio)",
+    )
+    argparser.add_argument(
+        "--breakdown",
+        nargs="*",
+        choices=DIMENSIONS,
+        help="Break the blended allocation down by these dimensions (all of them if "
+        "none is specified), exporting it next to the --out-file",
+    )
+    argparser.add_argument(
+        "--overlap",
+        action="store_true",
+        help="Compare the funds instead of blending them, computing the weighted "
+        "overlap and cosine similarity of each pair (requires numpy and scipy)",
+    )
+    argparser.add_argument(
+        "--matrix-file",
+        help="When comparing funds, exports their weights matrix to this .npz file",
+    )
+    argparser.add_argument(
+        "--batch",
+        help="Computes all the blends specified in this .json or .yaml file, "
+        "fetching every fund they reference only once",
+    )
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of concurrent fetches and blend processes used in batch mode "
+        "(and of concurrent fetches when comparing funds)",
+    )
+    argparser.add_argument(
+        "--queue",
+        help="Fetch funds through a work queue shared with other hosts, either the "
+        "path of a SQLite database or a <backend>://<location> URL. Reports the "
+        "progress of the queue until it's drained, unless --work is used",
+    )
+    argparser.add_argument(
+        "--enqueue",
+        action="store_true",
+        help="Add the funds (all the funds of the built-in adapters if none are "
+        "given) to the --queue",
+    )
+    argparser.add_argument(
+        "--work",
+        action="store_true",
+        help="Fetch funds from the --queue with --workers workers until it's drained",
+    )
+    argparser.add_argument(
+        "--lease",
+        type=float,
+        default=300,
+        help="Seconds a queue worker holds a fund for before it can be fetched by "
+        "another one, renewed while it's being fetched (default: 300)",
+    )
+    argparser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Fetch all the funds concurrently on a single event loop (requires aiohttp)",
+    )
+    argparser.add_argument(
+        "--look-through",
+        action="store_true",
+        help="Replace holdings which are themselves supported ETFs with their own "
+        "holdings, recursively",
+    )
+    argparser.add_argument(
+        "--max-depth",
+        type=int,
+        default=3,
+        help="Maximum number of nested funds expanded by --look-through (default: 3)",
+    )
+    argparser.add_argument(
+        "--deadline",
+        type=float,
+        help="Maximum amount of seconds spent fetching funds, after which the ones "
+        "still being fetched are cancelled",
+    )
+    argparser.add_argument(
+        "--partial",
+        action="store_true",
+        help="Blend whatever could be fetched in time, using the latest cached data "
+        "(however old) for funds which failed or missed the --deadline",
+    )
+    argparser.add_argument(
+        "--shared-cache",
+        action="store_true",
+        help="Read funds from the holdings shared by the etf4u processes on this "
+        "host through a memory-mapped file, publishing the ones fetched there",
+    )
+    argparser.add_argument(
+        "--ticker-aliases",
+        help="A .csv file of canonical tickers, each followed by its aliases (ticker "
+        "variants, CUSIP or ISIN), used along the built-in ones when parsing holdings",
+    )
     argparser.add_argument(
         "--no-cache",
         action="store_true",
         help="Don't use cache files to load or store data",
     )
+    argparser.add_argument(
+        "--reparse",
+        action="store_true",
+        help="Parse the funds again from their latest cached raw responses, "
+        "updating the cached holdings without fetching them",
+    )
+    argparser.add_argument(
+        "--stale-while-revalidate",
+        action="store_true",
+        help="Use holdings cached on a previous day straight away, refreshing them "
+        "in the background for the next run",
+    )
+    argparser.add_argument(
+        "--max-stale",
+        type=float,
+        default=72,
+        help="Maximum age in hours of stale cached holdings, after which they are "
+        "fetched again before blending (default: 72)",
+    )
+    argparser.add_argument(
+        "--plain",
+        action="store_true",
+        help="Plain log and output formatting, without loading rich (the default "
+        "when the output isn't a terminal)",
+    )
+    argparser.add_argument(
+        "-q", "--quiet", action="store_true", help="Only log warnings and errors"
+    )
     argparser.add_argument(
         "-v", "--verbose", action="store_true", help="Increase output log verbosity"
     )
     args = argparser.parse_args()
 
     # configure logging for the application
-    log = logging.getLogger("etf4u")
-    log.setLevel(logging.INFO if not args.verbose else logging.DEBUG)
-    rich_handler = RichHandler()
-    rich_handler.setFormatter(logging.Formatter(fmt="%(message)s", datefmt="[%X]"))
-    log.addHandler(rich_handler)
-    log.propagate = False
+    print = setup_output(args)
 
     # start the application
-    portfolio = {}
-    for fund in args.funds:
-        sanitized_fund = fund.lower()
-        for loader, name, _ in pkgutil.iter_modules(adapters.__path__):
-            adapter = loader.find_module(name).load_module(name)
-            if sanitized_fund in [f.lower() for f in adapter.FUNDS]:
-                log.info(f"Fetching ETF {sanitized_fund.upper()} using {name} adapter")
-                if args.no_cache:
-                    result = adapter.fetch(sanitized_fund)
-                else:
-                    result = query(sanitized_fund, adapter.fetch)
-                portfolio = combine_dicts(portfolio, result)
-                break
-        else:
-            log.warning(f"No adapter found for ETF {fund}, using default etfdbd adapter")
-            from adapters import etfdb
-
-            if args.no_cache:
-                result = etfdb.fetch(sanitized_fund)
-            else:
-                result = query(sanitized_fund, etfdb.fetch)
-
-            portfolio = combine_dicts(portfolio, result)
-
-    # process inclusion list / file
-    if len(args.include):
-        inclusion_list = args.include
-        if Path(inclusion_list[0]).is_file():
-            with open(inclusion_list[0]) as f:
-                inclusion_list = f.read().split()
-        portfolio = {
-            asset: weight
-            for (asset, weight) in portfolio.items()
-            if asset in inclusion_list
-        }
-
-    # process exclusion list / file
-    if len(args.exclude):
-        exclusion_list = args.include
-        if Path(exclusion_list[0]).is_file():
-            with open(exclusion_list[0]) as f:
-                exclusion_list = f.read().split()
-        portfolio = {
-            asset: weight
-            for (asset, weight) in portfolio.items()
-            if not asset in exclusion_list
-        }
-
-    # clamp assets amount if necessary
-    if args.clamp:
-        portfolio = dict(
-            sorted(portfolio.items(), key=operator.itemgetter(1), reverse=True)[
-                : args.clamp
-            ]
+    if args.ticker_aliases:
+        load_index(args.ticker_aliases)
+    cache_options = {
+        "stale_while_revalidate": args.stale_while_revalidate,
+        "max_stale": timedelta(hours=args.max_stale),
+    }
+    fetch_options = {
+        "expires": time.monotonic() + args.deadline if args.deadline else None,
+        "allow_partial": args.partial,
+        "shared_cache": args.shared_cache,
+    }
+    if args.queue:
+        if args.work and args.no_cache:
+            argparser.error(
+                "--work stores the funds it fetches in the cache, drop --no-cache"
+            )
+        run_queue(args)
+        return
+    if args.batch:
+        run_batch(
+            args.batch,
+            no_cache=args.no_cache,
+            workers=args.workers,
+            use_async=args.use_async,
+            max_depth=args.max_depth if args.look_through else None,
+            **fetch_options,
+            **cache_options,
         )
+        return
+    if not args.funds:
+        argparser.error("provide at least one fund symbol, or a --batch file")
 
-    # go through the portfolio, redistributing all weights to a 100% allocation value,
-    # and if any asset doesn't meet the minimum allocation value once redistributed,
-    # remove those from the portfolio and redistribute again afterwards
-    redistributed = False
-    while not redistributed:
-        total_fund_weight = sum([float(value) for value in portfolio.values()])
-        holdings_to_remove = []
-        redistribution_successful = True
-        for holding, weight in portfolio.items():
-            new_weight = round((weight * 100) / total_fund_weight, 2)
-            if new_weight >= args.minimum and not holding in args.exclude:
-                portfolio[holding] = new_weight
-            else:
-                log.debug(f"{holding} doesn't meet minimum allocation value")
-                holdings_to_remove.append(holding)
-                if redistribution_successful:
-                    redistribution_successful = False
-        for holding in holdings_to_remove:
-            del portfolio[holding]
-        redistributed = redistribution_successful
-
-    # reorder the holdings, from largest to smallest weight
-    portfolio = {
-        k: portfolio[k] for k in sorted(portfolio, key=portfolio.get, reverse=True)
+    if args.allocation:
+        if len(args.allocation) != len(args.funds):
+            argparser.error("--allocation needs a weight for every fund")
+        if min(args.allocation) < 0 or not sum(args.allocation):
+            argparser.error("--allocation weights must be positive")
+
+    if args.reparse and not args.no_cache:
+        for fund in args.funds:
+            reparse(fund.lower(), find_adapter(fund))
+
+    blend_options = {
+        "clamp": args.clamp,
+        "minimum": args.minimum,
+        "inclusion_list": load_tickers(args.include),
+        "exclusion_list": load_tickers(args.exclude),
+        "allocation": args.allocation,
     }
 
-    print(portfolio)
+    # the same blend of funds already cached today might have been computed before
+    use_results = not (args.no_cache or args.look_through or args.overlap or args.sweep)
+    result_key = get_result_key(args.funds, **blend_options) if use_results else None
+    portfolio = load_result(result_key) if result_key else None
+    metadata_funds = args.funds
+
+    if portfolio is None:
+        holdings, metadata_funds = fetch_holdings(
+            args, **fetch_options, **cache_options
+        )
+        missing = [fund.upper() for fund in args.funds if fund.lower() not in holdings]
+        if missing:
+            log.warning(f"Blending without ETFs {', '.join(missing)}")
+        if not holdings:
+            argparser.error("none of the funds could be fetched")
+
+        if args.overlap:
+            from overlap import compare, pairs, export_pairs, export_matrix
+
+            funds, tickers, matrix, overlap, similarity = compare(holdings)
+            funds_pairs = pairs(funds, overlap, similarity)
+            if args.print_top != 0:
+                print(funds_pairs[: args.print_top])
+            if args.out_file:
+                export_pairs(funds_pairs, args.out_file)
+            if args.matrix_file:
+                export_matrix(funds, tickers, matrix, args.matrix_file)
+            return
+
+        fetched = [fund for fund in args.funds if fund.lower() in holdings]
+        if args.sweep:
+            from allocation import read_allocations, sweep, export_sweep
+
+            try:
+                allocations = read_allocations(args.sweep, fetched)
+            except ValueError as e:
+                argparser.error(str(e))
+            results = sweep(
+                fetched,
+                [holdings[fund.lower()] for fund in fetched],
+                allocations,
+                blend_options["inclusion_list"],
+                blend_options["exclusion_list"],
+            )
+            if args.print_top != 0:
+                print(results[: args.print_top])
+            if args.out_file and results:
+                export_sweep(results, args.out_file)
+            return
+
+        if args.allocation:
+            blend_options["allocation"] = [
+                weight
+                for fund, weight in zip(args.funds, args.allocation)
+                if fund.lower() in holdings
+            ]
+            if not sum(blend_options["allocation"]):
+                argparser.error("none of the funds with an allocation could be fetched")
+        portfolio = blend([holdings[fund.lower()] for fund in fetched], **blend_options)
+
+        # only blends of every fund, as cached today, are stored
+        degraded = any(is_degraded(data) for data in holdings.values())
+        if use_results and not missing and not degraded:
+            result_key = get_result_key(args.funds, **blend_options)
+            if result_key:
+                store_result(result_key, portfolio)
+
+    allocation = None
+    if args.breakdown is not None:
+        dimensions = args.breakdown or DIMENSIONS
+        allocation = breakdown(portfolio, build_metadata(metadata_funds), dimensions)
+
+    if args.print_top != 0:
+        print(top(portfolio, args.print_top))
+        if allocation:
+            print(allocation)
 
     # export to file
     if args.out_file:
-        with open(args.out_file, "w") as csv_file:
-            log.info(f"Exporting to {args.out_file}...")
-            writer = csv.writer(csv_file, delimiter=",", lineterminator="\n")
-            for key, value in portfolio.items():
-                writer.writerow([key, value])
+        export(portfolio, args.out_file, args.out_format)
+        if allocation:
+            export_breakdown(allocation, get_breakdown_file(args.out_file))
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
-import csv, urllib.request, logging
-from utils import HEADERS
+import csv, io, logging
+from records import Records
+from tickers import canonical
+from utils import csv_downloads
 
 log = logging.getLogger(f"etf4u.{__name__}")
 
@@ -7,6 +9,19 @@ log = logging.getLogger(f"etf4u.{__name__}")
 
 FUNDS = ["arkk", "arkw", "arkq", "arkf", "arkg", "arkx", "prnt", "izrl"]
 
+BATCH = True
+TIMEOUT = 30
+
+# maps the fields of holdings records to the (normalized) labels of the .csv columns
+COLUMNS = {
+    "ticker": "ticker",
+    "name": "company",
+    "cusip": "cusip",
+    "shares": "shares",
+    "market_value": "marketvalue",
+    "weight": "weight",
+}
+
 
 def get_fund_file(fund):
     funds_filenames = {
@@ -26,12 +41,9 @@ def get_fund_file(fund):
     )
 
 
-def fetch(fund):
+def parse(content):
     result = {}
-    fund_csv_url = get_fund_file(fund)
-    req = urllib.request.Request(fund_csv_url, headers=HEADERS)
-    res = urllib.request.urlopen(req)
-    data = csv.reader([l.decode("utf-8") for l in res.readlines()])
+    data = csv.reader([l.decode("utf-8") for l in io.BytesIO(content)])
     next(data)
     for holding in data:
         try:
@@ -39,7 +51,21 @@ def fetch(fund):
             weight = holding[7]
             if not ticker or not weight:
                 continue
+            ticker = canonical(ticker, holding[4])
             result[ticker] = result.get(ticker, 0) + float(weight.strip("%"))  # /100
         except IndexError:
             continue
     return result
+
+
+def records(content):
+    rows = list(csv.reader([l.decode("utf-8") for l in io.BytesIO(content)]))
+    holdings = [row for row in rows[1:] if len(row) > 3 and row[3]]
+    return Records(rows[0], holdings, COLUMNS)
+
+
+download, download_async, download_many = csv_downloads(get_fund_file, TIMEOUT)
+
+
+def fetch(fund):
+    return parse(download(fund))
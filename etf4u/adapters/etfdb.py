@@ -1,5 +1,5 @@
-import urllib.request, logging, json, time
-from lxml import html
+import asyncio, html, urllib.request, logging, json, re, time
+from tickers import canonical
 from utils import HEADERS
 
 log = logging.getLogger(f"etf4u.{__name__}")
@@ -11,33 +11,93 @@ log = logging.getLogger(f"etf4u.{__name__}")
 
 FUNDS = []
 
+# one page load and four api requests, spaced out, per fund
+COST = 5
+MAX_CONCURRENCY = 2
+RATE_LIMIT = 1
+TIMEOUT = 60
+
+
+# the fund's page is read in chunks, only until the holdings table's tag is found
+CHUNK_SIZE = 16 * 1024
+TAG_OVERLAP = 1024
+HOLDINGS_TABLE = re.compile(
+    rb"<table\b[^>]*\bdata-hash=[\"']etf-holdings[\"'][^>]*>", re.IGNORECASE
+)
+DATA_URL = re.compile(rb"\bdata-url=[\"']([^\"']*)[\"']", re.IGNORECASE)
+TAGS = re.compile(r"<[^>]*>")
+
+QUERIES = [
+    "&sort=weight&order=asc",
+    "&sort=weight&order=desc",
+    "&sort=symbol&order=asc",
+    "&sort=symbol&order=desc",
+]
+
+
+def get_fund_page(fund):
+    return f"https://etfdb.com/etf/{fund.upper()}/"
+
+
+def get_holdings_path(chunks):
+    # the only thing needed from the fund's page is the url of its holdings table, so
+    # the page is scanned as it's downloaded for that table's tag (keeping enough of
+    # the previous chunk to find a tag split between two chunks) and the rest of the
+    # page is never read nor parsed
+    page = b""
+    for chunk in chunks:
+        start = max(0, len(page) - TAG_OVERLAP)
+        page += chunk
+        tag = HOLDINGS_TABLE.search(page, start)
+        if tag:
+            url = DATA_URL.search(tag.group(0))
+            if url:
+                return html.unescape(url.group(1).decode("utf-8"))
+        page = page[-TAG_OVERLAP:]
+    raise ValueError("No holdings table found on the fund's page")
+
+
+def add_holdings(result, holdings):
+    # the symbols are links to the holdings' pages, their text is extracted from all the
+    # rows at once rather than parsing every one of them as a html fragment
+    rows = holdings["rows"]
+    symbols = TAGS.sub("", "\n".join(row["symbol"].replace("\n", " ") for row in rows))
+    for symbol, row in zip(html.unescape(symbols).split("\n"), rows):
+        weight = float(row["weight"].strip("%"))
+        if symbol != "N/A":
+            result[canonical(symbol)] = weight
+
 
 def fetch(fund):
     result = {}
-    fund_csv_url = f"https://etfdb.com/etf/{fund.upper()}/"
+    fund_csv_url = get_fund_page(fund)
     req = urllib.request.Request(fund_csv_url, headers=HEADERS)
-    res = urllib.request.urlopen(req, timeout=60)
-    tree = html.parse(res)
-    table = tree.xpath("//table[@data-hash='etf-holdings']")[0]
+    with urllib.request.urlopen(req, timeout=TIMEOUT) as res:
+        holdings_path = get_holdings_path(iter(lambda: res.read(CHUNK_SIZE), b""))
 
     # the api returns 15 results, but we can iterate different sorting
     # criterias in the request to maximize the number of different holdings
-    for query in [
-        "&sort=weight&order=asc",
-        "&sort=weight&order=desc",
-        "&sort=symbol&order=asc",
-        "&sort=symbol&order=desc",
-    ]:
+    for query in QUERIES:
         log.debug(f"fetching query {query}")
-        holdings_url = f"https://etfdb.com/{table.get('data-url')}{query}"
+        holdings_url = f"https://etfdb.com/{holdings_path}{query}"
         holdings_req = urllib.request.Request(holdings_url, headers=HEADERS)
-        holdings_res = urllib.request.urlopen(holdings_req)
-        holdings = json.loads(holdings_res.read().decode("utf-8"))
-        for row in holdings["rows"]:
-            symbol = html.fromstring(row["symbol"]).text_content()
-            weight = float(row["weight"].strip("%"))
-            if symbol != "N/A":
-                result[symbol] = weight
+        holdings_res = urllib.request.urlopen(holdings_req, timeout=TIMEOUT)
+        add_holdings(result, json.loads(holdings_res.read().decode("utf-8")))
         time.sleep(0.5)
 
     return result
+
+
+async def fetch_async(fund, session):
+    result = {}
+    page = await session.get(get_fund_page(fund), timeout=TIMEOUT)
+    holdings_path = get_holdings_path([page])
+    for query in QUERIES:
+        log.debug(f"fetching query {query}")
+        holdings_url = f"https://etfdb.com/{holdings_path}{query}"
+        add_holdings(
+            result, json.loads(await session.get(holdings_url, timeout=TIMEOUT))
+        )
+        await asyncio.sleep(0.5)
+
+    return result
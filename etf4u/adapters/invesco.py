@@ -1,5 +1,7 @@
-import csv, urllib.request, logging
-from utils import HEADERS
+import csv, io, logging
+from records import Records
+from tickers import canonical
+from utils import csv_downloads
 
 log = logging.getLogger(f"etf4u.{__name__}")
 
@@ -13,12 +15,9 @@ def get_fund_file(fund):
     )
 
 
-def fetch(fund):
+def parse(content):
     result = {}
-    fund_csv_url = get_fund_file(fund)
-    req = urllib.request.Request(fund_csv_url, headers=HEADERS)
-    res = urllib.request.urlopen(req)
-    data = csv.reader([l.decode("utf-8") for l in res.readlines()])
+    data = csv.reader([l.decode("utf-8") for l in io.BytesIO(content)])
     next(data)
     for holding in data:
         try:
@@ -26,12 +25,23 @@ def fetch(fund):
             weight = holding[5]
             if ticker.startswith("-") or not ticker or not weight:
                 continue
+            ticker = canonical(ticker, holding[1])
             result[ticker] = result.get(ticker, 0) + float(weight)
         except IndexError:
             continue
     return result
 
 
+def records(content):
+    rows = list(csv.reader([l.decode("utf-8") for l in io.BytesIO(content)]))
+    holdings = [row for row in rows[1:] if len(row) > 2 and row[2].strip()]
+    return Records(rows[0], holdings, COLUMNS)
+
+
+def fetch(fund):
+    return parse(download(fund))
+
+
 # To get a full list of all Invesco ETFs, navigate to https://www.invesco.com/us/financial-products/etfs/
 # and run the following lines of javascript code:
 """
@@ -267,3 +277,19 @@ FUNDS = [
     "PVI",
     "VRIG",
 ]
+
+BATCH = True
+TIMEOUT = 30
+
+download, download_async, download_many = csv_downloads(get_fund_file, TIMEOUT)
+
+# maps the fields of holdings records to the (normalized) labels of the .csv columns
+COLUMNS = {
+    "ticker": "holdingticker",
+    "name": "name",
+    "sector": "sector",
+    "cusip": "securityidentifier",
+    "shares": "sharesparvalue",
+    "market_value": "marketvalue",
+    "weight": "weight",
+}
@@ -1,5 +1,7 @@
-import csv, urllib.request, logging
-from utils import HEADERS
+import csv, io, logging
+from records import Records, normalize_label
+from tickers import canonical
+from utils import csv_downloads
 
 log = logging.getLogger(f"etf4u.{__name__}")
 
@@ -49,6 +51,26 @@ FUNDS = ["aaxj", "acwf", "acwi", "acwv", "acwx", "agg", "agt", "agz", "aia", "am
         "tecb", "tflo", "thd", "tip", "tlh", "tlt", "tok", "tur", "uae", "urth", "ushy", 
         "usig", "usmv", "usrt", "usxf", "vegi", "vlue", "wood", "wps", "xjh", "xjr", "xt", "xvv"]
 
+BATCH = True
+TIMEOUT = 30
+
+# maps the fields of holdings records to the (normalized) labels of the .csv columns
+COLUMNS = {
+    "ticker": "ticker",
+    "name": "name",
+    "sector": "sector",
+    "asset_class": "assetclass",
+    "country": "location",
+    "currency": "currency",
+    "cusip": "cusip",
+    "isin": "isin",
+    "shares": "shares",
+    "price": "price",
+    "market_value": "marketvalue",
+    "weight": "weight",
+}
+
+
 def get_fund_file(symbol):
     funds_basepaths = {
         "aaxj": "/239601/ishares-msci-all-country-asia-ex-japan-etf/1467271812596.ajax",
@@ -440,14 +462,16 @@ def get_fund_file(symbol):
     )
 
 
-def fetch(fund):
+def parse(content):
     result = {}
-    fund_csv_url = get_fund_file(fund)
-    req = urllib.request.Request(fund_csv_url, headers=HEADERS)
-    res = urllib.request.urlopen(req)
-    data = csv.reader([l.decode("utf-8").strip() for l in res.readlines()])
-    for i in range(0, 10):
+    data = csv.reader([l.decode("utf-8").strip() for l in io.BytesIO(content)])
+    for i in range(0, 9):
         next(data)
+    # not every file lists the identifiers of the holdings, nor in the same column
+    header = [normalize_label(label) for label in next(data)]
+    identifiers = [
+        header.index(label) for label in ("cusip", "isin") if label in header
+    ]
     for holding in data:
         try:
             ticker = holding[0]
@@ -455,7 +479,31 @@ def fetch(fund):
             asset_class = holding[3]
             if not ticker or not weight or not (asset_class == "Equity"):
                 continue
+            ticker = canonical(ticker, *[holding[i] for i in identifiers])
             result[ticker] = result.get(ticker, 0) + float(weight)
         except IndexError:
             break
-    return result
\ No newline at end of file
+    return result
+
+
+def records(content):
+    # the holdings table starts after 9 lines of information about the fund, and
+    # ends at the first line which doesn't have enough columns (the disclaimers)
+    rows = csv.reader([l.decode("utf-8").strip() for l in io.BytesIO(content)])
+    for i in range(0, 9):
+        next(rows)
+    header = next(rows)
+    holdings = []
+    for row in rows:
+        if len(row) < 6:
+            break
+        if row[0]:
+            holdings.append(row)
+    return Records(header, holdings, COLUMNS)
+
+
+download, download_async, download_many = csv_downloads(get_fund_file, TIMEOUT)
+
+
+def fetch(fund):
+    return parse(download(fund))
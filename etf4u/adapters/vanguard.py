@@ -1,5 +1,6 @@
 import json, logging
 from pathlib import Path
+from tickers import canonical
 from utils import HEADERS
 
 from seleniumwire import webdriver
@@ -39,13 +40,23 @@ def get_fund_file(symbol):
     return f"https://investor.vanguard.com/etf/profile/portfolio/{symbol.upper()}/portfolio-holdings"
 
 
-def fetch(fund):
-    result = {}
+def download(fund):
     fund_url = get_fund_file(fund)
     driver = get_chromedriver(headless=True)
-    driver.get(fund_url)
-    request = driver.wait_for_request(r"(?=.*stock\.jsonp)^https://api.vanguard.com")
-    body = request.response.body.decode("utf-8")
+    try:
+        driver.set_page_load_timeout(TIMEOUT)
+        driver.get(fund_url)
+        request = driver.wait_for_request(
+            r"(?=.*stock\.jsonp)^https://api.vanguard.com", timeout=TIMEOUT
+        )
+        return request.response.body
+    finally:
+        driver.quit()
+
+
+def parse(content):
+    result = {}
+    body = content.decode("utf-8")
 
     # the json data text is wrapped inside a `angular.callbacks._6()` function call
     # extract it so we can load it properly
@@ -53,10 +64,15 @@ def fetch(fund):
     json_data = json.loads(data)
     holdings = json_data["fund"]["entity"]
     for holding in holdings:
-        result[holding["ticker"]] = float(holding["percentWeight"])
+        ticker = canonical(holding["ticker"], holding.get("cusip"), holding.get("isin"))
+        result[ticker] = result.get(ticker, 0) + float(holding["percentWeight"])
     return result
 
 
+def fetch(fund):
+    return parse(download(fund))
+
+
 # To get a full list of all Vanguard ETFs, navigate to https://investor.vanguard.com/etf/list#/etf/
 # and run the following lines of javascript code:
 """
@@ -216,3 +232,8 @@ FUNDS = [
     "VNQ",
     "VPU",
 ]
+
+# every fund drives its own headless Chrome instance
+COST = 20
+MAX_CONCURRENCY = 1
+TIMEOUT = 90
@@ -0,0 +1,145 @@
+import asyncio, logging, time
+
+from cache import query, needs_fetch, store
+from funds import fall_back
+from utils import HEADERS
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# The async mode fetches all the funds on a single event loop, sharing one aiohttp
+# client session (and its pool of connections) between all the adapters, so that
+# hundreds of funds can be in flight at once without a thread for each of them.
+# Adapters provide an async `download_async(fund, session)` or `fetch_async(fund,
+# session)` function next to their synchronous `fetch`, the ones which don't are run
+# in a worker thread instead
+
+
+class AsyncSession:
+    def __init__(self, limit=100, limit_per_host=8):
+        try:
+            import aiohttp
+        except ImportError:
+            raise SystemExit("aiohttp is required to fetch funds asynchronously")
+        self.aiohttp = aiohttp
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.session = None
+
+    async def __aenter__(self):
+        connector = self.aiohttp.TCPConnector(
+            limit=self.limit, limit_per_host=self.limit_per_host
+        )
+        self.session = self.aiohttp.ClientSession(headers=HEADERS, connector=connector)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def get(self, url, timeout=None):
+        options = {}
+        if timeout:
+            options["timeout"] = self.aiohttp.ClientTimeout(total=timeout)
+        async with self.session.get(url, **options) as res:
+            res.raise_for_status()
+            return await res.read()
+
+
+class Throttle:
+    # the async counterpart of Adapter.slot(), enforcing the adapter's concurrency and
+    # rate limits on the event loop
+    def __init__(self, adapter):
+        self.semaphore = asyncio.Semaphore(max(1, adapter.max_concurrency))
+        self.rate_limit = adapter.rate_limit
+        self.rate_lock = asyncio.Lock()
+        self.last_fetch = 0
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        if self.rate_limit:
+            async with self.rate_lock:
+                loop = asyncio.get_event_loop()
+                wait = self.last_fetch + self.rate_limit - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self.last_fetch = loop.time()
+
+    async def __aexit__(self, *exc):
+        self.semaphore.release()
+
+
+async def fetch_fund_async(fund, adapter, session, throttle, no_cache, cache_options):
+    log.info(f"Fetching ETF {fund.upper()} using {adapter.name} adapter")
+    # cached funds are read straight away, without going through the event loop
+    if not no_cache and not needs_fetch(fund, **cache_options):
+        return query(fund, adapter.throttled_fetch, **cache_options)
+
+    # funds of a provider being skipped fall back like in the synchronous mode
+    if not adapter.breaker.allow():
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, fall_back, fund, adapter, no_cache)
+
+    try:
+        async with throttle:
+            # the adapter's timeout bounds the whole fetch, not just its requests
+            data, content = await asyncio.wait_for(
+                adapter.fetch_raw_async(fund, session), adapter.timeout
+            )
+    except Exception as e:
+        adapter.breaker.record_error(e)
+        raise
+    adapter.breaker.record_success()
+    if data and not no_cache:
+        store(fund, data, content)
+    return data
+
+
+async def fetch_funds_async(
+    plan, no_cache=False, expires=None, allow_partial=False, limit=100, **cache_options
+):
+    throttles = {}
+    for _, adapter in plan:
+        throttles.setdefault(adapter.name, Throttle(adapter))
+    async with AsyncSession(limit=limit) as session:
+        tasks = [
+            asyncio.ensure_future(
+                fetch_fund_async(
+                    fund,
+                    adapter,
+                    session,
+                    throttles[adapter.name],
+                    no_cache,
+                    cache_options,
+                )
+            )
+            for fund, adapter in plan
+        ]
+        done, pending = set(), set()
+        if tasks:
+            timeout = max(0, expires - time.monotonic()) if expires else None
+            done, pending = await asyncio.wait(tasks, timeout=timeout)
+
+        # fetches still running at the deadline are cancelled, and waited on so that
+        # they're done with the session before it's closed
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    results = {}
+    for (fund, _), task in zip(plan, tasks):
+        if task not in done:
+            continue
+        if task.exception() is not None:
+            if not allow_partial:
+                raise task.exception()
+            log.warning(f"Could not fetch ETF {fund.upper()}: {task.exception()}")
+            continue
+        results[fund] = task.result()
+    return results
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
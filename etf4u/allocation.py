@@ -0,0 +1,139 @@
+import csv, logging
+
+try:
+    import numpy as np
+except ImportError:
+    raise SystemExit("numpy is required to blend funds with allocations")
+
+from blend import select
+from overlap import weights_matrix
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# Blends with a target allocation for every fund (60% of one, 30% of another, ...)
+# scale the holdings of each fund to its share of the blend instead of adding up their
+# raw weights. The funds' holdings become the rows of the same sparse fund x ticker
+# matrix used to compare funds (short positions included), every row normalized to sum
+# up to 1, so that the blend is a single sparse product of the allocation vector with
+# that matrix. Many candidate allocations of the same funds (a sweep) are evaluated the
+# same way, as the product of a matrix of allocations with the funds' matrix, computed
+# in blocks to bound the memory used by the dense results
+
+# candidate allocations evaluated at once during a sweep
+SWEEP_BLOCK = 256
+# the share of a blend held by its largest holdings is reported by sweeps
+TOP_HOLDINGS = 10
+
+
+def normalize_allocation(allocation):
+    # a vector of weights, or a matrix with a row of weights per allocation
+    allocation = np.asarray(allocation, dtype=np.float64)
+    totals = allocation.sum(axis=-1, keepdims=True)
+    if (allocation < 0).any() or (totals == 0).any():
+        raise ValueError("Allocations must be positive weights")
+    return allocation / totals
+
+
+def allocate(matrix, allocation):
+    # the weight of every ticker in the blend, as a vector for a single allocation or
+    # a matrix with a row per allocation, computed as (matrix.T @ allocation.T).T so
+    # that the sparse matrix drives the product
+    return (matrix.T @ normalize_allocation(allocation).T).T
+
+
+def weighted_portfolio(holdings, allocation, inclusion_list=None, exclusion_list=None):
+    # the blended weights (adding up to 100) of the tickers passing the inclusion and
+    # exclusion lists, to be redistributed like the ones of an equally weighted blend
+    tickers, matrix = weights_matrix(holdings)
+    weights = allocate(matrix, allocation) * 100
+    portfolio = {tickers[i]: float(weights[i]) for i in np.flatnonzero(weights)}
+    return select(portfolio, inclusion_list or [], exclusion_list or [])
+
+
+def read_allocations(path, funds):
+    # a .csv file with a header of fund symbols and a row of weights per allocation,
+    # read as a matrix with a column per fund (in the order of `funds`)
+    with open(path, "r", newline="") as csv_file:
+        reader = csv.reader(csv_file)
+        header = [fund.strip().lower() for fund in next(reader, [])]
+        missing = [fund.upper() for fund in funds if fund.lower() not in header]
+        if missing:
+            raise ValueError(f"No allocation for {', '.join(missing)} in {path}")
+        columns = [header.index(fund.lower()) for fund in funds]
+        rows = []
+        for row in reader:
+            if not row:
+                continue
+            try:
+                weights = [float(row[i] or 0) for i in columns]
+            except (ValueError, IndexError):
+                weights = None
+            if not weights or min(weights) < 0 or not sum(weights):
+                raise ValueError(
+                    f"Allocation on line {reader.line_num} of {path} isn't a positive "
+                    "weight for every fund"
+                )
+            rows.append(weights)
+    if not rows:
+        raise ValueError(f"No allocations in {path}")
+    return np.array(rows, dtype=np.float64)
+
+
+def sweep(funds, holdings, allocations, inclusion_list=None, exclusion_list=None):
+    # evaluates every allocation of the funds, returning for each one its number of
+    # holdings, its largest holding, the share of its largest holdings and its
+    # effective number of holdings (the inverse of the Herfindahl index of its weights)
+    tickers, matrix = weights_matrix(holdings)
+    selected = np.array(
+        [
+            (not inclusion_list or ticker in inclusion_list)
+            and ticker not in (exclusion_list or [])
+            for ticker in tickers
+        ],
+        dtype=bool,
+    )
+    tickers = [ticker for ticker, kept in zip(tickers, selected) if kept]
+    matrix = matrix[:, np.flatnonzero(selected)]
+    if not tickers:
+        raise ValueError("None of the holdings pass the inclusion and exclusion lists")
+    top = min(TOP_HOLDINGS, len(tickers))
+    log.info(f"Evaluating {len(allocations)} allocations of {len(funds)} funds")
+
+    results = []
+    for start in range(0, len(allocations), SWEEP_BLOCK):
+        block = allocations[start : start + SWEEP_BLOCK]
+        weights = np.asarray(allocate(matrix, block))
+        # excluded tickers are redistributed over the rest of the blend
+        totals = weights.sum(axis=1, keepdims=True)
+        totals[totals == 0] = 1
+        weights = weights / totals
+        count = (weights != 0).sum(axis=1)
+        largest = weights.argmax(axis=1)
+        top_weight = -np.partition(-weights, top - 1, axis=1)[:, :top].sum(axis=1)
+        concentration = (weights**2).sum(axis=1)
+        concentration[concentration == 0] = np.inf
+        for i, allocation in enumerate(normalize_allocation(block)):
+            results.append(
+                {
+                    **{
+                        fund.upper(): round(float(weight) * 100, 2)
+                        for fund, weight in zip(funds, allocation)
+                    },
+                    "holdings": int(count[i]),
+                    "largest_holding": tickers[largest[i]],
+                    "largest_weight": round(float(weights[i, largest[i]]) * 100, 2),
+                    f"top_{TOP_HOLDINGS}_weight": round(float(top_weight[i]) * 100, 2),
+                    "effective_holdings": round(float(1 / concentration[i]), 2),
+                }
+            )
+    return results
+
+
+def export_sweep(results, out_file):
+    log.info(f"Exporting to {out_file}...")
+    with open(out_file, "w", newline="") as csv_file:
+        writer = csv.DictWriter(
+            csv_file, fieldnames=list(results[0].keys()), lineterminator="\n"
+        )
+        writer.writeheader()
+        writer.writerows(results)
@@ -0,0 +1,218 @@
+import json, logging
+from pathlib import Path
+
+from blend import blend
+from breakdown import DIMENSIONS, breakdown, build_metadata
+from cache import is_degraded
+from funds import fetch_funds
+from lookthrough import fetch_graph, graph_funds, look_through
+from output import export, export_breakdown, get_breakdown_file
+from results import get_result_key, load_result, store_result
+from watchlists import load_tickers
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# The batch mode reads a file of blend specifications, fetches the union of all the
+# funds they reference only once, then computes every blend in its own worker process.
+# The file can be either JSON or YAML (which requires PyYAML) and contains a list of
+# blends (or a dictionary with a `blends` key holding that list), each one using the
+# same options available on the command line, for example:
+#
+# blends:
+#   - funds: [ARKK, ARKW, ARKQ]
+#     clamp: 50
+#     exclude: restricted.txt
+#     out_file: blend_ark.csv
+#     breakdown: [sector, country]
+#   - funds: [VTI, IXUS, ARKK]
+#     allocation: {VTI: 60, IXUS: 30, ARKK: 10}
+#     out_file: blend_core.csv
+
+
+def load_specs(path):
+    path = Path(path)
+    with open(path, "r") as f:
+        if path.suffix.lower() in [".yaml", ".yml"]:
+            try:
+                import yaml
+            except ImportError:
+                raise SystemExit("PyYAML is required to read YAML batch files")
+            specs = yaml.safe_load(f)
+        else:
+            specs = json.load(f)
+
+    if isinstance(specs, dict):
+        specs = specs.get("blends", [])
+    for i, spec in enumerate(specs):
+        # a single fund can be given as a string rather than a list
+        spec["funds"] = as_list(spec.get("funds"))
+        if not spec["funds"]:
+            raise ValueError(f"Blend #{i + 1} in {path} doesn't specify any funds")
+        allocation = get_allocation(spec)
+        if allocation is not None and not valid_allocation(allocation, spec["funds"]):
+            raise ValueError(
+                f"The allocation of blend #{i + 1} in {path} isn't a positive weight "
+                "for every fund"
+            )
+    return specs
+
+
+def as_list(value):
+    if not value:
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+
+def get_allocation(spec, fetched=None):
+    # `allocation` can be either a list of weights in the same order as the funds, or
+    # a dictionary of weights by fund. Only the weights of the fetched funds are kept
+    allocation = spec.get("allocation")
+    if allocation is None:
+        return None
+    if isinstance(allocation, dict):
+        weights = {fund.lower(): weight for fund, weight in allocation.items()}
+        allocation = [weights.get(fund.lower(), 0) for fund in spec["funds"]]
+    if fetched is None:
+        return list(allocation)
+    return [
+        weight
+        for fund, weight in zip(spec["funds"], allocation)
+        if fund.lower() in fetched
+    ]
+
+
+def valid_allocation(allocation, funds):
+    # a weight for every fund, none of them negative and not all of them zero
+    return (
+        len(allocation) == len(funds)
+        and all(
+            isinstance(weight, (int, float)) and not isinstance(weight, bool)
+            for weight in allocation
+        )
+        and min(allocation) >= 0
+        and sum(allocation) > 0
+    )
+
+
+def get_dimensions(spec):
+    # `breakdown` can be either a list of dimensions, or true for all of them
+    dimensions = spec.get("breakdown")
+    if dimensions is True:
+        return DIMENSIONS
+    return as_list(dimensions)
+
+
+def get_ticker_lists(spec):
+    return {
+        "inclusion_list": load_tickers(as_list(spec.get("include"))),
+        "exclusion_list": load_tickers(as_list(spec.get("exclude"))),
+    }
+
+
+def run_blend(spec, holdings, metadata=None, use_results=False, ticker_lists=None):
+    # `ticker_lists` are the spec's compiled inclusion and exclusion lists, read from
+    # their files when not given
+    blend_options = {
+        "clamp": spec.get("clamp", 0),
+        "minimum": spec.get("minimum", 0.0),
+        **(ticker_lists or get_ticker_lists(spec)),
+        "allocation": spec.get("allocation"),
+    }
+    result_key = None
+    if use_results:
+        result_key = get_result_key(spec["funds"], **blend_options)
+    portfolio = load_result(result_key) if result_key else None
+    if portfolio is None:
+        portfolio = blend(holdings, **blend_options)
+        if result_key:
+            store_result(result_key, portfolio)
+    out_file = spec.get("out_file", spec.get("out-file"))
+    if out_file:
+        export(portfolio, out_file, spec.get("out_format", spec.get("out-format")))
+    dimensions = get_dimensions(spec)
+    if dimensions and out_file:
+        allocation = breakdown(portfolio, metadata or {}, dimensions)
+        export_breakdown(allocation, get_breakdown_file(out_file))
+    return portfolio
+
+
+def run_batch(
+    path,
+    no_cache=False,
+    workers=4,
+    use_async=False,
+    max_depth=None,
+    expires=None,
+    allow_partial=False,
+    shared_cache=False,
+    **cache_options,
+):
+    specs = load_specs(path)
+    funds = [fund for spec in specs for fund in spec["funds"]]
+
+    def fetch(funds):
+        return fetch_funds(
+            funds,
+            no_cache=no_cache,
+            workers=workers,
+            use_async=use_async,
+            expires=expires,
+            allow_partial=allow_partial,
+            shared_cache=shared_cache,
+            **cache_options,
+        )
+
+    # with a maximum depth, holdings which are funds themselves are looked through
+    graph = None
+    if max_depth is not None:
+        graph = fetch_graph(funds, fetch, max_depth)
+        fetched = look_through(funds, graph, max_depth)
+    else:
+        fetched = fetch(funds)
+
+    # every worker only receives the holdings (and metadata, for breakdowns) of the
+    # funds its blend needs, the metadata of each fund being loaded only once (for
+    # blends looked through, the metadata of their underlying funds as well)
+    jobs = [
+        [fetched[fund.lower()] for fund in spec["funds"] if fund.lower() in fetched]
+        for spec in specs
+    ]
+    specs = [{**spec, "allocation": get_allocation(spec, fetched)} for spec in specs]
+    for i, spec in enumerate(specs):
+        if spec["allocation"] is not None and not sum(spec["allocation"]):
+            log.warning(
+                f"None of the funds with an allocation in blend #{i + 1} were fetched"
+            )
+            specs[i] = {**spec, "allocation": None}
+            jobs[i] = []
+    funds_metadata = {}
+    metadata = []
+    for spec in specs:
+        spec_metadata = {}
+        spec_funds = graph_funds(spec["funds"], graph) if graph else spec["funds"]
+        for fund in spec_funds if get_dimensions(spec) else []:
+            if fund.lower() not in funds_metadata:
+                funds_metadata[fund.lower()] = build_metadata([fund])
+            for ticker, values in funds_metadata[fund.lower()].items():
+                spec_metadata.setdefault(ticker, values)
+        metadata.append(spec_metadata)
+    # blends of funds which were all fetched (and not served stale or by the fallback
+    # adapter) can be looked up in, and stored to, the blend results cache
+    use_results = [
+        not no_cache
+        and max_depth is None
+        and len(holdings) == len(spec["funds"])
+        and not any(is_degraded(data) for data in holdings)
+        for spec, holdings in zip(specs, jobs)
+    ]
+    # the inclusion and exclusion lists are compiled here rather than in the workers,
+    # so every list file is only read once however many blends (and workers) use it
+    ticker_lists = [get_ticker_lists(spec) for spec in specs]
+    log.info(f"Computing {len(specs)} blends from {len(fetched)} funds...")
+    # imported here as it's much slower to import than the rest of the batch mode
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(
+            executor.map(run_blend, specs, jobs, metadata, use_results, ticker_lists)
+        )
@@ -0,0 +1,225 @@
+import bisect, heapq, logging, operator
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# an IncrementalBlend update changing more than this share of its tickers sorts them
+# all again, rather than moving each one of them in place
+RESORT_RATIO = 1 / 64
+
+
+def combine_dicts(a, b, op=operator.add):
+    return {**a, **b, **{k: op(float(a[k]), float(b[k])) for k in a.keys() & b}}
+
+
+def select(portfolio, inclusion_list, exclusion_list):
+    # process inclusion and exclusion lists
+    if inclusion_list or exclusion_list:
+        portfolio = {
+            asset: weight
+            for (asset, weight) in portfolio.items()
+            if (not inclusion_list or asset in inclusion_list)
+            and asset not in exclusion_list
+        }
+    return portfolio
+
+
+def redistribute(portfolio, clamp=0, minimum=0.0, exclusion_list=None, total=None):
+    # `total` is the sum of the portfolio's weights, when the caller already knows it
+    exclusion_list = exclusion_list or frozenset()
+
+    # clamp assets amount if necessary, selecting the largest holdings with a heap
+    # (in O(n log k) rather than sorting all of them), which also returns them from
+    # the largest to the smallest
+    ordered = False
+    if clamp:
+        portfolio = dict(
+            heapq.nlargest(clamp, portfolio.items(), key=operator.itemgetter(1))
+        )
+        total = None
+        ordered = True
+
+    # go through the portfolio, redistributing all weights to a 100% allocation value,
+    # and if any asset doesn't meet the minimum allocation value once redistributed,
+    # remove those from the portfolio and redistribute again afterwards
+    redistributed = False
+    while not redistributed:
+        if total is None:
+            total = sum([float(value) for value in portfolio.values()])
+        total_fund_weight, total = total, None
+        holdings_to_remove = []
+        redistribution_successful = True
+        for holding, weight in portfolio.items():
+            new_weight = round((weight * 100) / total_fund_weight, 2)
+            if new_weight >= minimum and not holding in exclusion_list:
+                portfolio[holding] = new_weight
+            else:
+                log.debug(f"{holding} doesn't meet minimum allocation value")
+                holdings_to_remove.append(holding)
+                if redistribution_successful:
+                    redistribution_successful = False
+        for holding in holdings_to_remove:
+            del portfolio[holding]
+        redistributed = redistribution_successful
+
+    # reorder the holdings, from largest to smallest weight. Clamped holdings already
+    # are: redistributing scales all weights by the same factor and rounding them
+    # keeps their order, so ties stay where a stable sort would leave them
+    if ordered:
+        return portfolio
+    return {k: portfolio[k] for k in sorted(portfolio, key=portfolio.get, reverse=True)}
+
+
+def blend(
+    holdings,
+    clamp=0,
+    minimum=0.0,
+    inclusion_list=None,
+    exclusion_list=None,
+    allocation=None,
+):
+    inclusion_list = inclusion_list or frozenset()
+    exclusion_list = exclusion_list or frozenset()
+
+    # with an allocation (a weight for every fund, in the same order as the holdings)
+    # the funds are scaled to their share of the blend rather than added up
+    if allocation is not None:
+        # imported here as it requires numpy and scipy
+        from allocation import weighted_portfolio
+
+        portfolio = weighted_portfolio(
+            holdings, allocation, inclusion_list, exclusion_list
+        )
+        return redistribute(portfolio, clamp, minimum, exclusion_list)
+
+    portfolio = {}
+    for result in holdings:
+        portfolio = combine_dicts(portfolio, result)
+
+    portfolio = select(portfolio, inclusion_list, exclusion_list)
+    return redistribute(portfolio, clamp, minimum, exclusion_list)
+
+
+class IncrementalBlend:
+    # A blend kept up to date as the holdings of its funds change one at a time, for
+    # long running callers refreshing funds individually. The weight every fund
+    # contributes to each ticker is kept, so updating a fund only sums again the
+    # tickers it holds (or used to hold) and adjusts the total weight of the blend by
+    # their difference, instead of merging every fund again. `portfolio()` gives the
+    # same result as `blend()` over the current holdings of the funds (in the order
+    # they were added), tickers being ranked like `combine_dicts` would merge them so
+    # that ties, and the holdings kept by `clamp`, are the same. The tickers are kept
+    # sorted by rank, and by weight (ties by rank) for `clamp`, updates only moving the
+    # tickers which changed, so a refresh doesn't have to sort the whole blend again
+    def __init__(self, clamp=0, minimum=0.0, inclusion_list=None, exclusion_list=None):
+        self.clamp = clamp
+        self.minimum = minimum
+        self.inclusion_list = inclusion_list or frozenset()
+        self.exclusion_list = exclusion_list or frozenset()
+        # fund -> {ticker: position in the fund's holdings}
+        self.funds = {}
+        # fund -> the order it was added in
+        self.order = {}
+        self.added = 0
+        # ticker -> {fund: weight}
+        self.contributions = {}
+        # ticker -> blended weight, only for the tickers passing the inclusion and
+        # exclusion lists
+        self.totals = {}
+        self.total = 0.0
+        # ticker -> rank, and the (rank, ticker) and (-weight, rank, ticker) entries of
+        # the same tickers in ascending order
+        self.ranks = {}
+        self.ranked = []
+        self.weighted = []
+
+    def included(self, ticker):
+        return (
+            not self.inclusion_list or ticker in self.inclusion_list
+        ) and ticker not in self.exclusion_list
+
+    def rank(self, ticker):
+        # tickers are merged in the order of the first fund holding them, then in the
+        # order of that fund's holdings
+        fund = min(self.contributions[ticker], key=self.order.__getitem__)
+        return self.order[fund], self.funds[fund][ticker]
+
+    def entries(self, ticker):
+        rank = self.ranks[ticker]
+        return (rank, ticker), (-self.totals[ticker], rank, ticker)
+
+    def move(self, ticker, insert):
+        # removes (or inserts) the ticker's entries from the sorted lists
+        for entries, entry in zip((self.ranked, self.weighted), self.entries(ticker)):
+            if insert:
+                bisect.insort(entries, entry)
+            else:
+                del entries[bisect.bisect_left(entries, entry)]
+
+    def update(self, fund, holdings):
+        # replaces the holdings of a fund (adding it if it's new), returning the
+        # tickers whose blended weight changed. The fund's tickers are walked in their
+        # own order, followed by the ones it doesn't hold anymore
+        previous = self.funds.get(fund, {})
+        if fund not in self.order:
+            self.order[fund] = self.added
+            self.added += 1
+        # positions are kept rather than the holdings themselves, so callers can reuse
+        # the dictionary they passed
+        self.funds[fund] = {ticker: i for i, ticker in enumerate(holdings)}
+        changed = list(holdings) + [t for t in previous if t not in holdings]
+        resort = len(changed) > len(self.ranks) * RESORT_RATIO
+        for ticker in changed:
+            contributions = self.contributions.setdefault(ticker, {})
+            if ticker in holdings:
+                contributions[fund] = float(holdings[ticker])
+            else:
+                contributions.pop(fund, None)
+            if not contributions:
+                del self.contributions[ticker]
+            if not self.included(ticker):
+                continue
+            if ticker in self.ranks and not resort:
+                self.move(ticker, insert=False)
+            # weights are added up in the order of the funds, like blend() does
+            weight = sum(
+                contributions[holder]
+                for holder in sorted(contributions, key=self.order.__getitem__)
+            )
+            self.total += weight - self.totals.get(ticker, 0.0)
+            if contributions:
+                self.totals[ticker] = weight
+                self.ranks[ticker] = self.rank(ticker)
+                if not resort:
+                    self.move(ticker, insert=True)
+            else:
+                self.totals.pop(ticker, None)
+                self.ranks.pop(ticker, None)
+        if resort:
+            entries = [self.entries(ticker) for ticker in self.ranks]
+            self.ranked = sorted(ranked for ranked, _ in entries)
+            self.weighted = sorted(weighted for _, weighted in entries)
+        return changed
+
+    def remove(self, fund):
+        changed = self.update(fund, {})
+        del self.funds[fund]
+        del self.order[fund]
+        return changed
+
+    def portfolio(self):
+        # the holdings `clamp` would keep are the first ones by weight, already in the
+        # order it would return them in
+        if self.clamp:
+            return redistribute(
+                {ticker: -weight for weight, _, ticker in self.weighted[: self.clamp]},
+                0,
+                self.minimum,
+                self.exclusion_list,
+            )
+        return redistribute(
+            {ticker: self.totals[ticker] for _, ticker in self.ranked},
+            0,
+            self.minimum,
+            self.exclusion_list,
+            total=self.total,
+        )
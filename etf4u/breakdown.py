@@ -0,0 +1,46 @@
+import logging
+
+from funds import load_records
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# Breaks the allocation of a blended portfolio down by sector, country and asset class,
+# using the holdings records of the blended funds (read from their cached raw responses,
+# so no extra downloads are needed). The metadata of all the funds is merged into a
+# single index by ticker first, then every dimension is aggregated in one pass over the
+# portfolio's holdings
+
+DIMENSIONS = ["sector", "country", "asset_class"]
+UNKNOWN = "Unknown"
+
+
+def build_metadata(funds):
+    metadata = {}
+    for fund in funds:
+        records = load_records(fund)
+        if records is None:
+            log.debug(f"No holdings records available for {fund.upper()}")
+            continue
+        columns = [records.column(dimension) for dimension in DIMENSIONS]
+        for i, ticker in enumerate(records.column("ticker")):
+            if ticker and ticker not in metadata:
+                metadata[ticker] = tuple(column[i] for column in columns)
+    return metadata
+
+
+def breakdown(portfolio, metadata, dimensions=DIMENSIONS):
+    indexes = [DIMENSIONS.index(dimension) for dimension in dimensions]
+    unknown = (None,) * len(DIMENSIONS)
+    totals = [{} for _ in dimensions]
+    for ticker, weight in portfolio.items():
+        values = metadata.get(ticker, unknown)
+        for total, index in zip(totals, indexes):
+            value = values[index] or UNKNOWN
+            total[value] = total.get(value, 0) + weight
+    return {
+        dimension: {
+            value: round(weight, 2)
+            for value, weight in sorted(total.items(), key=lambda i: i[1], reverse=True)
+        }
+        for dimension, total in zip(dimensions, totals)
+    }
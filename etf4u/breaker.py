@@ -0,0 +1,107 @@
+import http.client, logging, sys, threading, time, urllib.error
+from contextlib import contextmanager
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# When a provider is down or degraded, every one of its funds would fail in turn, each
+# one only after waiting for the adapter's timeout. Every adapter has a circuit breaker
+# which trips after a number of consecutive failures: fetches from the provider are then
+# refused straight away for a cool-down period, and the funds are served from the cache
+# or the fallback adapter instead. Once the cool-down is over a single fetch is let
+# through to probe the provider, closing the breaker again if it succeeds. Only
+# failures showing the provider is unavailable (timeouts, connection errors and server
+# errors) count: a fund it doesn't know about or a page which can't be parsed means the
+# provider did answer
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_unavailable(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500
+    # asyncio, aiohttp and selenium are only checked for when something imported them
+    asyncio = sys.modules.get("asyncio")
+    if asyncio and isinstance(error, asyncio.TimeoutError):
+        return True
+    aiohttp = sys.modules.get("aiohttp")
+    if aiohttp and isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    if aiohttp and isinstance(error, aiohttp.ClientConnectionError):
+        return True
+    selenium = sys.modules.get("selenium.common.exceptions")
+    if selenium and isinstance(error, selenium.TimeoutException):
+        return True
+    # URLError, ConnectionError and socket timeouts are all OSError
+    return isinstance(error, (OSError, TimeoutError, http.client.HTTPException))
+
+
+class CircuitBreaker:
+    def __init__(self, name, threshold=3, cooldown=300):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def tripped(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            log.info(f"Probing the {self.name} adapter again")
+            self.probing = True
+            return True
+
+    def retry_after(self):
+        # seconds until the next fetch is let through to probe the provider
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            return max(0, self.opened_at + self.cooldown - time.monotonic())
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                log.info(f"The {self.name} adapter is available again")
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                if self.opened_at is None or self.probing:
+                    log.warning(
+                        f"The {self.name} adapter failed {self.failures} times in a "
+                        f"row, skipping it for {self.cooldown} seconds"
+                    )
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def record_error(self, error):
+        # errors which don't show the provider is unavailable count as an answer
+        if is_unavailable(error):
+            self.record_failure()
+        else:
+            self.record_success()
+
+    @contextmanager
+    def guard(self):
+        if not self.allow():
+            raise CircuitOpenError(f"The {self.name} adapter is unavailable")
+        try:
+            yield
+        except Exception as e:
+            self.record_error(e)
+            raise
+        self.record_success()
@@ -0,0 +1,273 @@
+import os, csv, gzip, hashlib, logging, threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# Fetched holdings are cached on a daily basis as gzipped .csv files of tickers and
+# weights. When the adapter can provide it, the raw response downloaded from the
+# provider is kept as well (gzipped, and named after its content hash) so that the
+# holdings can be parsed again locally, for example after improving an adapter
+
+CACHE_DIR = Path(".cache")
+RAW_CACHE_DIR = CACHE_DIR / "raw"
+
+# funds currently being fetched in this process, so that concurrent callers asking for
+# the same fund wait on the one in-flight fetch instead of starting their own
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def single_flight(key, fn):
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        log.debug(f"Waiting on in-flight fetch for {key}")
+        return future.result()
+
+    try:
+        result = fn()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+
+@contextmanager
+def file_lock(path):
+    # exclusive advisory lock held across processes sharing the same cache directory
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as lock_file:
+        if os.name == "nt":
+            import msvcrt
+
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        else:
+            import fcntl
+
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class Holdings(dict):
+    # a fund's holdings dictionary, flagged as stale when served from an outdated cache
+    # and as fallback when fetched by the fallback adapter instead of the fund's own
+    __slots__ = ("stale", "fallback")
+
+    def __init__(self, *args, stale=False, fallback=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stale = stale
+        self.fallback = fallback
+
+
+def is_degraded(data):
+    # stale or fallback holdings are good enough for a blend, but aren't shared with
+    # other processes nor used for the cached blend results
+    return getattr(data, "stale", False) or getattr(data, "fallback", False)
+
+
+def read_cached(cached_file, stale=False):
+    with gzip.open(cached_file, "rt") as csv_file:
+        reader = csv.reader(csv_file)
+        return Holdings({rows[0]: float(rows[1]) for rows in reader}, stale=stale)
+
+
+def write_atomic(path, write):
+    # write to a temporary file first and move it in place, so readers never see a
+    # partially written cache file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    write(temp_file)
+    os.replace(temp_file, path)
+
+
+def write_cached(cached_file, data):
+    def write(path):
+        with gzip.open(path, "wt") as csv_file:
+            log.debug(f"Caching data to file: {cached_file}")
+            writer = csv.writer(csv_file, delimiter=",", lineterminator="\n")
+            writer.writerows(data.items())
+
+    write_atomic(cached_file, write)
+
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()[:16]
+
+
+def write_raw(fund, content, now=None):
+    now = now or datetime.now()
+    raw_file = RAW_CACHE_DIR / (
+        f"{fund.upper()}_{now.strftime('%Y%m%d')}_{content_hash(content)}.gz"
+    )
+    if raw_file.is_file():
+        return raw_file
+
+    def write(path):
+        with gzip.open(path, "wb") as f:
+            log.debug(f"Caching raw response to file: {raw_file}")
+            f.write(content)
+
+    write_atomic(raw_file, write)
+    return raw_file
+
+
+def find_latest_raw(fund):
+    pattern = f"{fund.upper()}_{'[0-9]' * 8}_*.gz"
+    raw_files = sorted(RAW_CACHE_DIR.glob(pattern))
+    return raw_files[-1] if raw_files else None
+
+
+def get_cached_file(fund, now=None):
+    now = now or datetime.now()
+    return CACHE_DIR / f"{fund.upper()}_{now.strftime('%Y%m%d')}.csv.gz"
+
+
+def get_lock_file(fund):
+    return CACHE_DIR / ".locks" / f"{fund.upper()}.lock"
+
+
+def find_latest_cached(fund):
+    # cache files are named after the day they were fetched, so the last one is the newest
+    pattern = f"{fund.upper()}_{'[0-9]' * 8}.csv.gz"
+    cached_files = sorted(CACHE_DIR.glob(pattern))
+    return cached_files[-1] if cached_files else None
+
+
+def find_stale_cached(fund, now, max_stale=None):
+    stale_file = find_latest_cached(fund)
+    if stale_file:
+        age = now - datetime.fromtimestamp(stale_file.stat().st_mtime)
+        if max_stale is None or age <= max_stale:
+            return stale_file
+        log.debug(f"Cached data for {fund.upper()} is too old, fetching it again")
+    return None
+
+
+def needs_fetch(fund, stale_while_revalidate=False, max_stale=None):
+    # whether querying the fund would have to wait on a network fetch
+    now = datetime.now()
+    if get_cached_file(fund, now).is_file():
+        return False
+    return not (stale_while_revalidate and find_stale_cached(fund, now, max_stale))
+
+
+def load_latest(fund):
+    # the latest holdings cached for a fund, however old they are, for when fetching
+    # it again didn't work out
+    latest_file = find_latest_cached(fund)
+    if latest_file is None:
+        return None
+    return read_cached(latest_file, stale=latest_file != get_cached_file(fund))
+
+
+def store(fund, data, content=None):
+    cached_file = get_cached_file(fund)
+    with file_lock(get_lock_file(fund)):
+        if content is not None:
+            write_raw(fund, content)
+        write_cached(cached_file, data)
+
+
+def read_raw(raw_file):
+    with gzip.open(raw_file, "rb") as f:
+        content = f.read()
+    if not raw_file.stem.endswith(content_hash(content)):
+        log.warning(f"Raw response cached in {raw_file} is corrupted, ignoring it")
+        return None
+    return content
+
+
+def reparse(fund, adapter):
+    # parses the latest raw response cached for the fund again, replacing the holdings
+    # cached for the same day, without fetching anything from the provider
+    raw_file = find_latest_raw(fund)
+    content = read_raw(raw_file) if raw_file else None
+    if content is None:
+        log.warning(f"No raw response cached for {fund.upper()}, can't parse it again")
+        return None
+
+    log.info(f"Parsing {fund.upper()} again from cached file: {raw_file}")
+    data = adapter.parse(content)
+    date = datetime.strptime(raw_file.stem.split("_")[-2], "%Y%m%d")
+    with file_lock(get_lock_file(fund)):
+        write_cached(get_cached_file(fund, date), data)
+    return data
+
+
+def load_records(fund, adapter):
+    # the full holdings records of the fund, read from its latest cached raw response
+    raw_file = find_latest_raw(fund)
+    content = read_raw(raw_file) if raw_file else None
+    if content is None:
+        return None
+    return adapter.records(content)
+
+
+def refresh(fund, fetch_method, cached_file):
+    def fetch_and_cache():
+        with file_lock(get_lock_file(fund)):
+            # another process might have cached the fund while we were waiting
+            if cached_file.is_file():
+                log.debug(f"Using data cached by another process: {cached_file}")
+                return read_cached(cached_file)
+            data, content = fetch_method(fund)
+            if data:
+                if content is not None:
+                    write_raw(fund, content)
+                write_cached(cached_file, data)
+            return data
+
+    return single_flight(cached_file.name, fetch_and_cache)
+
+
+def refresh_in_background(fund, fetch_method, cached_file):
+    try:
+        refresh(fund, fetch_method, cached_file)
+    except Exception as e:
+        log.warning(f"Background refresh of {fund.upper()} failed: {e}")
+
+
+def query(fund, fetch_method, stale_while_revalidate=False, max_stale=None):
+    now = datetime.now()
+    cached_file = get_cached_file(fund, now)
+    if cached_file.is_file():
+        log.debug(f"Using data from cached file: {cached_file}")
+        return read_cached(cached_file)
+
+    # serve holdings cached on a previous day straight away, as long as they are not
+    # older than the maximum staleness, and refresh them in the background for the
+    # next caller. The refresh thread is not a daemon, so it completes before exiting
+    if stale_while_revalidate:
+        stale_file = find_stale_cached(fund, now, max_stale)
+        if stale_file:
+            log.info(f"Using stale data for {fund.upper()} while refreshing it")
+            threading.Thread(
+                target=refresh_in_background,
+                args=(fund, fetch_method, cached_file),
+                name=f"refresh-{fund}",
+            ).start()
+            return read_cached(stale_file, stale=True)
+
+    return refresh(fund, fetch_method, cached_file)
@@ -0,0 +1,271 @@
+import logging, threading, time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import cache
+from breaker import CircuitOpenError
+from cache import Holdings, is_degraded, query, needs_fetch, load_latest, store
+from registry import registry
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+
+def find_adapter(fund):
+    adapter = registry.find(fund)
+    if adapter:
+        return adapter
+    log.warning(f"No adapter found for ETF {fund}, using default etfdbd adapter")
+    return registry.fallback()
+
+
+def fall_back(fund, adapter, no_cache=False):
+    # funds of an adapter whose circuit breaker is open are served from their latest
+    # cached holdings, or else fetched with the fallback adapter (without caching its
+    # results, which are usually less complete, under the fund's name)
+    data = None if no_cache else load_latest(fund)
+    if data is not None:
+        log.warning(
+            f"The {adapter.name} adapter is unavailable, using cached {fund.upper()}"
+        )
+        return data
+    fallback = registry.fallback()
+    if fallback is adapter:
+        raise CircuitOpenError(f"The {adapter.name} adapter is unavailable")
+    log.warning(
+        f"The {adapter.name} adapter is unavailable, fetching ETF {fund.upper()} "
+        f"using {fallback.name} adapter"
+    )
+    return Holdings(fallback.throttled_fetch(fund)[0], fallback=True)
+
+
+def fetch_fund(fund, no_cache=False, adapter=None, **cache_options):
+    sanitized_fund = fund.lower()
+    adapter = adapter or find_adapter(sanitized_fund)
+    log.info(f"Fetching ETF {sanitized_fund.upper()} using {adapter.name} adapter")
+
+    try:
+        if no_cache:
+            return adapter.throttled_fetch(sanitized_fund)[0]
+        return query(sanitized_fund, adapter.throttled_fetch, **cache_options)
+    except CircuitOpenError:
+        return fall_back(sanitized_fund, adapter, no_cache)
+    except Exception as e:
+        # the failure which trips the breaker falls back too
+        if not adapter.breaker.tripped:
+            raise
+        log.warning(f"Could not fetch ETF {sanitized_fund.upper()}: {e}")
+        return fall_back(sanitized_fund, adapter, no_cache)
+
+
+def load_records(fund):
+    # the full holdings records (name, sector, market value, etc.) of an already
+    # fetched fund, parsed from its cached raw response without any network request
+    return cache.load_records(fund.lower(), find_adapter(fund))
+
+
+def fetch_single(fund, no_cache=False, adapter=None, **cache_options):
+    return {fund: fetch_fund(fund, no_cache, adapter, **cache_options)}
+
+
+def fetch_batch(adapter, funds, no_cache=False):
+    log.info(
+        f"Fetching ETFs {', '.join(f.upper() for f in funds)} "
+        f"in batch using {adapter.name} adapter"
+    )
+    # while the provider is skipped, the funds are left to be fetched (or fall back)
+    # one by one
+    results = {}
+    if not adapter.breaker.allow():
+        return results
+    try:
+        with adapter.slot():
+            for fund, data, content in adapter.fetch_many(funds):
+                if data and not no_cache:
+                    store(fund, data, content)
+                results[fund] = data
+    except Exception as e:
+        adapter.breaker.record_error(e)
+        raise
+    if results:
+        adapter.breaker.record_success()
+    else:
+        adapter.breaker.record_failure()
+    return results
+
+
+def plan_batches(plan, no_cache=False, **cache_options):
+    # group the funds which would need to be downloaded by adapters that can fetch
+    # several of them at once. A batch holds a single slot of its adapter, so the funds
+    # are split into up to `max_concurrency` batches fetched side by side, each one
+    # sharing its connection, and batches are only worth it for two funds or more
+    batches = {}
+    for fund, adapter in plan:
+        if adapter.batch and (no_cache or needs_fetch(fund, **cache_options)):
+            batches.setdefault(adapter.name, (adapter, []))[1].append(fund)
+    chunks = []
+    for adapter, funds in batches.values():
+        count = min(max(1, adapter.max_concurrency), len(funds))
+        chunks.extend((adapter, funds[i::count]) for i in range(count))
+    return [chunk for chunk in chunks if len(chunk[1]) > 1]
+
+
+def run_task(task, funds, allow_partial=False, cancelled=None):
+    # cancelled tasks which haven't started yet are skipped, and in partial mode the
+    # failure of a task only means its funds will be missing from the results
+    if cancelled and cancelled.is_set():
+        return {}
+    try:
+        return task()
+    except Exception as e:
+        if not allow_partial:
+            raise
+        log.warning(f"Could not fetch ETF {', '.join(f.upper() for f in funds)}: {e}")
+        return {}
+
+
+def run_tasks(tasks, workers=1, expires=None, allow_partial=False):
+    results = {}
+    if workers <= 1 and not expires:
+        for _, funds, task in tasks:
+            results.update(run_task(task, funds, allow_partial))
+        return results
+
+    # start the most expensive fetches first so they don't end up as the long tail
+    # of the run, each adapter's own concurrency and rate limits are enforced. With a
+    # deadline, even a single worker fetches in the background so it can be abandoned
+    tasks = sorted(tasks, key=lambda task: task[0], reverse=True)
+    cancelled = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    futures = [
+        executor.submit(run_task, task, funds, allow_partial, cancelled)
+        for _, funds, task in tasks
+    ]
+    timeout = max(0, expires - time.monotonic()) if expires else None
+    done, not_done = wait(futures, timeout=timeout)
+
+    # fetches still running when the deadline expires are left to finish on their own
+    # (bounded by their adapter's timeouts), the others are not started at all
+    cancelled.set()
+    for future in not_done:
+        future.cancel()
+    executor.shutdown(wait=False)
+    for future in futures:
+        if future in done:
+            results.update(future.result())
+    return results
+
+
+def complete(funds, results, no_cache=False, allow_partial=False):
+    missing = [fund for fund in funds if fund not in results]
+    if missing and not allow_partial:
+        missing = ", ".join(fund.upper() for fund in missing)
+        raise TimeoutError(f"Funds not fetched before the deadline: {missing}")
+
+    # in partial mode, funds which couldn't be fetched in time are served from the
+    # latest data cached for them, no matter how old, or left out of the results
+    for fund in missing:
+        data = None if no_cache else load_latest(fund)
+        if data is not None:
+            stale = "stale " if data.stale else ""
+            log.warning(f"Using {stale}cached data for {fund.upper()}")
+            results[fund] = data
+        else:
+            log.warning(f"Continuing without ETF {fund.upper()}")
+    return {fund: results[fund] for fund in funds if fund in results}
+
+
+def fetch_funds(
+    funds,
+    no_cache=False,
+    workers=1,
+    use_async=False,
+    expires=None,
+    allow_partial=False,
+    shared_cache=False,
+    **cache_options,
+):
+    # fetch every distinct fund once, returning a dictionary of holdings by fund symbol.
+    # `expires` is the time.monotonic() by which the fetches must be over, those not
+    # done by then (or failing, with `allow_partial`) are left out of the dictionary
+    unique_funds = list(dict.fromkeys(fund.lower() for fund in funds))
+    if not shared_cache or no_cache:
+        return fetch_unique(
+            unique_funds,
+            no_cache,
+            workers,
+            use_async,
+            expires,
+            allow_partial,
+            **cache_options,
+        )
+
+    # funds another process already published to the shared segment are read from it,
+    # the others are fetched and published for the next processes
+    from shared import find_shared, publish
+
+    shared = find_shared(unique_funds)
+    if shared:
+        log.info(f"Using {len(shared)} funds from the shared holdings segment")
+    fetched = fetch_unique(
+        [fund for fund in unique_funds if fund not in shared],
+        no_cache,
+        workers,
+        use_async,
+        expires,
+        allow_partial,
+        **cache_options,
+    )
+    publish(
+        {fund: data for fund, data in fetched.items() if data and not is_degraded(data)}
+    )
+    results = {**shared, **fetched}
+    return {fund: results[fund] for fund in unique_funds if fund in results}
+
+
+def fetch_unique(
+    unique_funds,
+    no_cache=False,
+    workers=1,
+    use_async=False,
+    expires=None,
+    allow_partial=False,
+    **cache_options,
+):
+    plan = [(fund, find_adapter(fund)) for fund in unique_funds]
+    if use_async:
+        from aio import fetch_funds_async, run
+
+        results = run(
+            fetch_funds_async(plan, no_cache, expires, allow_partial, **cache_options)
+        )
+        return complete(unique_funds, results, no_cache, allow_partial)
+
+    batches = plan_batches(plan, no_cache, **cache_options)
+    batched_funds = {fund for _, batch_funds in batches for fund in batch_funds}
+    plan = [(fund, adapter) for fund, adapter in plan if fund not in batched_funds]
+
+    # every task returns a dictionary of holdings by fund symbol
+    tasks = [
+        (
+            adapter.cost * len(batch_funds),
+            batch_funds,
+            partial(fetch_batch, adapter, batch_funds, no_cache),
+        )
+        for adapter, batch_funds in batches
+    ] + [
+        (
+            adapter.cost,
+            [fund],
+            partial(fetch_single, fund, no_cache, adapter, **cache_options),
+        )
+        for fund, adapter in plan
+    ]
+    results = run_tasks(tasks, workers, expires, allow_partial)
+
+    # funds a batch download didn't return are fetched on their own
+    retries = [
+        (1, [fund], partial(fetch_single, fund, no_cache, **cache_options))
+        for fund in batched_funds - results.keys()
+    ]
+    results.update(run_tasks(retries, 1, expires, allow_partial))
+    return complete(unique_funds, results, no_cache, allow_partial)
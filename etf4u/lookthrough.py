@@ -0,0 +1,108 @@
+import logging
+
+from registry import registry
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# Funds of funds (like the iShares allocation ETFs) hold other ETFs, which would appear
+# as single tickers in a blend. The look-through mode replaces every holding which is
+# itself a fund supported by one of the adapters with that fund's own holdings,
+# weighted by the holding's weight, recursively up to a maximum depth. The whole graph
+# of funds is fetched first, one level at a time, so that every underlying fund is
+# fetched and parsed only once no matter how many parents hold it (and so that the
+# breakdowns can describe the holdings of the underlying funds as well)
+
+
+def is_fund(ticker):
+    return registry.find(ticker) is not None
+
+
+def fetch_graph(funds, fetch_funds, max_depth):
+    holdings = {}
+    level = list(dict.fromkeys(fund.lower() for fund in funds))
+    for depth in range(max_depth + 1):
+        holdings.update(fetch_funds(level))
+        if depth == max_depth:
+            break
+        level = list(
+            dict.fromkeys(
+                ticker.lower()
+                for fund in level
+                for ticker in holdings.get(fund, {})
+                if ticker.lower() not in holdings and is_fund(ticker)
+            )
+        )
+        if not level:
+            break
+        log.info(f"Looking through {len(level)} underlying funds")
+    return holdings
+
+
+def graph_funds(funds, holdings):
+    # the funds of the graph held by the funds, directly or not, level by level after
+    # the funds themselves (the funds found are visited in turn as the list grows)
+    found = list(
+        dict.fromkeys(fund.lower() for fund in funds if fund.lower() in holdings)
+    )
+    seen = set(found)
+    for fund in found:
+        for ticker in holdings[fund]:
+            underlying = ticker.lower()
+            if holdings.get(underlying) and underlying not in seen:
+                seen.add(underlying)
+                found.append(underlying)
+    return found
+
+
+def look_through(funds, holdings, max_depth=3):
+    # the holdings of the funds with every underlying fund of the graph expanded
+    expanded = {}
+    reachable = {}
+
+    def reach(fund):
+        # every fund of the graph held by the fund, directly or not
+        if fund not in reachable:
+            found = set()
+            pending = [fund]
+            while pending:
+                for ticker in holdings[pending.pop()]:
+                    underlying = ticker.lower()
+                    if holdings.get(underlying) and underlying not in found:
+                        found.add(underlying)
+                        pending.append(underlying)
+            reachable[fund] = frozenset(found)
+        return reachable[fund]
+
+    def expand(fund, depth, path):
+        # cycles are only cut at the funds of the path the fund can reach again, which
+        # are part of the key so that a fund expanded below a cycle doesn't hand its
+        # truncated expansion to parents outside of that cycle
+        key = (fund, depth, path & reach(fund))
+        if key in expanded:
+            return expanded[key]
+        result = {}
+        for ticker, weight in holdings[fund].items():
+            underlying = ticker.lower()
+            if depth < max_depth and holdings.get(underlying) and underlying in path:
+                log.warning(
+                    f"Cyclic holding of {ticker} in {fund.upper()}, not expanded"
+                )
+            elif depth < max_depth and holdings.get(underlying):
+                underlying_total = sum(holdings[underlying].values())
+                underlying_holdings = expand(underlying, depth + 1, path | {underlying})
+                for sub_ticker, sub_weight in underlying_holdings.items():
+                    result[sub_ticker] = (
+                        result.get(sub_ticker, 0)
+                        + weight * sub_weight / underlying_total
+                    )
+                continue
+            result[ticker] = result.get(ticker, 0) + weight
+        expanded[key] = result
+        return result
+
+    # funds which couldn't be fetched (in partial mode) are left out
+    return {
+        fund.lower(): expand(fund.lower(), 0, frozenset([fund.lower()]))
+        for fund in funds
+        if fund.lower() in holdings
+    }
@@ -0,0 +1,81 @@
+import csv, logging
+from itertools import islice
+from pathlib import Path
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# The portfolio can be exported as a .csv file, streamed through a large write buffer,
+# or as a Parquet or Arrow IPC file (which require pyarrow) for downstream jobs that
+# would otherwise have to parse the .csv back
+
+FORMATS = ["csv", "parquet", "arrow"]
+EXTENSIONS = {".parquet": "parquet", ".pq": "parquet", ".arrow": "arrow"}
+EXTENSIONS.update({".feather": "arrow", ".ipc": "arrow"})
+BUFFER_SIZE = 1024 * 1024
+
+
+def guess_format(out_file):
+    return EXTENSIONS.get(Path(out_file).suffix.lower(), "csv")
+
+
+def export_csv(portfolio, out_file):
+    with open(out_file, "w", buffering=BUFFER_SIZE) as csv_file:
+        writer = csv.writer(csv_file, delimiter=",", lineterminator="\n")
+        writer.writerows(portfolio.items())
+
+
+def to_table(portfolio):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise SystemExit("pyarrow is required to export Parquet and Arrow files")
+    return pa.table(
+        {
+            "ticker": pa.array(list(portfolio.keys()), type=pa.string()),
+            "weight": pa.array(list(portfolio.values()), type=pa.float64()),
+        }
+    )
+
+
+def export_parquet(portfolio, out_file):
+    import pyarrow.parquet as pq
+
+    pq.write_table(to_table(portfolio), out_file)
+
+
+def export_arrow(portfolio, out_file):
+    import pyarrow as pa
+
+    table = to_table(portfolio)
+    with pa.OSFile(str(out_file), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def export(portfolio, out_file, out_format=None):
+    out_format = out_format or guess_format(out_file)
+    log.info(f"Exporting to {out_file}...")
+    exporters = {"csv": export_csv, "parquet": export_parquet, "arrow": export_arrow}
+    exporters[out_format](portfolio, out_file)
+
+
+def get_breakdown_file(out_file):
+    # blend.csv -> blend.breakdown.csv
+    return Path(out_file).with_suffix(".breakdown.csv")
+
+
+def export_breakdown(breakdown, out_file):
+    log.info(f"Exporting breakdown to {out_file}...")
+    with open(out_file, "w", buffering=BUFFER_SIZE) as csv_file:
+        writer = csv.writer(csv_file, delimiter=",", lineterminator="\n")
+        for dimension, weights in breakdown.items():
+            writer.writerows(
+                (dimension, value, weight) for value, weight in weights.items()
+            )
+
+
+def top(portfolio, amount=None):
+    # the first holdings of the (already sorted) portfolio, or all of them
+    if amount is None:
+        return portfolio
+    return dict(islice(portfolio.items(), amount))
@@ -0,0 +1,107 @@
+import csv, logging
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    raise SystemExit("numpy and scipy are required to compare funds")
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# Compares funds by their holdings: every fund becomes a row of a sparse fund x ticker
+# matrix of weights (normalized to sum up to 1), from which the pairwise cosine
+# similarity is a single sparse matrix product, and the weighted overlap (the sum of the
+# smallest weight of every ticker held by both funds) is accumulated ticker by ticker,
+# only over the funds actually holding each ticker
+
+
+def weights_matrix(holdings, long_only=False):
+    # the sparse fund x ticker matrix of a list of holdings dictionaries, every row
+    # normalized to sum up to 1 (after dropping short positions, if `long_only`). The
+    # tickers are numbered in the order they appear in, which is the order they would
+    # have when adding up the funds. Blends with allocations use the same matrix
+    tickers = {}
+    rows, columns, weights = [], [], []
+    for row, fund_holdings in enumerate(holdings):
+        for ticker, weight in fund_holdings.items():
+            rows.append(row)
+            columns.append(tickers.setdefault(ticker, len(tickers)))
+            weights.append(float(weight))
+    matrix = sparse.csr_matrix(
+        (weights, (rows, columns)),
+        shape=(len(holdings), len(tickers)),
+        dtype=np.float64,
+    )
+    if long_only:
+        matrix.data[matrix.data < 0] = 0
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    totals[totals == 0] = 1
+    matrix = sparse.diags(1 / totals) @ matrix
+    return list(tickers.keys()), matrix.tocsr()
+
+
+def build_matrix(holdings):
+    funds = list(holdings.keys())
+    tickers, matrix = weights_matrix([holdings[fund] for fund in funds], long_only=True)
+    return funds, tickers, matrix
+
+
+def cosine_similarity(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    normalized = sparse.diags(1 / norms) @ matrix
+    return (normalized @ normalized.T).toarray()
+
+
+def weighted_overlap(matrix):
+    columns = matrix.tocsc()
+    overlap = np.zeros((matrix.shape[0], matrix.shape[0]))
+    for column in range(columns.shape[1]):
+        start, end = columns.indptr[column], columns.indptr[column + 1]
+        funds = columns.indices[start:end]
+        weights = columns.data[start:end]
+        overlap[np.ix_(funds, funds)] += np.minimum.outer(weights, weights)
+    return overlap
+
+
+def compare(holdings):
+    funds, tickers, matrix = build_matrix(holdings)
+    log.info(f"Comparing {len(funds)} funds holding {len(tickers)} different assets")
+    return funds, tickers, matrix, weighted_overlap(matrix), cosine_similarity(matrix)
+
+
+def pairs(funds, overlap, similarity):
+    # every pair of different funds, from the most to the least overlapping
+    first, second = np.triu_indices(len(funds), k=1)
+    order = np.argsort(-overlap[first, second], kind="stable")
+    return [
+        (
+            funds[first[i]].upper(),
+            funds[second[i]].upper(),
+            round(float(overlap[first[i], second[i]]) * 100, 2),
+            round(float(similarity[first[i], second[i]]), 4),
+        )
+        for i in order
+    ]
+
+
+def export_pairs(pairs, out_file):
+    log.info(f"Exporting to {out_file}...")
+    with open(out_file, "w") as csv_file:
+        writer = csv.writer(csv_file, delimiter=",", lineterminator="\n")
+        writer.writerow(["fund_a", "fund_b", "overlap", "cosine_similarity"])
+        writer.writerows(pairs)
+
+
+def export_matrix(funds, tickers, matrix, out_file):
+    # the sparse weights matrix in compressed sparse row form, with its labels
+    log.info(f"Exporting weights matrix to {out_file}...")
+    np.savez_compressed(
+        out_file,
+        data=matrix.data,
+        indices=matrix.indices,
+        indptr=matrix.indptr,
+        shape=matrix.shape,
+        funds=np.array([fund.upper() for fund in funds]),
+        tickers=np.array(tickers),
+    )
@@ -0,0 +1,104 @@
+import re
+
+from tickers import canonical
+
+# Besides tickers and weights, the files published by most providers list the name,
+# sector, market value, shares, identifiers, etc. of every holding. Records keep the
+# rows of such a file as they were read and only parse a column the first time it's
+# asked for, so that blends which never look at those details don't pay for them.
+# Adapters map these fields to the labels of the columns in their provider's files
+
+FIELDS = [
+    "ticker",
+    "name",
+    "sector",
+    "asset_class",
+    "country",
+    "currency",
+    "cusip",
+    "isin",
+    "shares",
+    "price",
+    "market_value",
+    "weight",
+]
+NUMERIC_FIELDS = {"shares", "price", "market_value", "weight"}
+
+
+def normalize_label(label):
+    # "Market Value ($)" -> "marketvalue"
+    return re.sub(r"\(.*?\)|[^a-z0-9]", "", label.lower())
+
+
+def to_number(value):
+    try:
+        return float(value.replace(",", "").replace("$", "").strip("% "))
+    except ValueError:
+        return None
+
+
+class Record:
+    __slots__ = ("records", "index")
+
+    def __init__(self, records, index):
+        self.records = records
+        self.index = index
+
+    def __getattr__(self, field):
+        if field not in FIELDS:
+            raise AttributeError(field)
+        return self.records.column(field)[self.index]
+
+    def __repr__(self):
+        return f"Record({self.ticker!r}, {self.weight!r})"
+
+
+class Records:
+    __slots__ = ("indexes", "rows", "columns")
+
+    def __init__(self, header, rows, labels):
+        positions = {normalize_label(label): i for i, label in enumerate(header)}
+        self.indexes = {
+            field: positions[label]
+            for field, label in labels.items()
+            if label in positions
+        }
+        self.rows = rows
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for index in range(len(self.rows)):
+            yield Record(self, index)
+
+    def column(self, field):
+        if field not in self.columns:
+            index = self.indexes.get(field)
+            if index is None:
+                values = [None] * len(self.rows)
+            else:
+                values = [
+                    row[index].strip() if index < len(row) else "" for row in self.rows
+                ]
+                if field in NUMERIC_FIELDS:
+                    values = [to_number(value) for value in values]
+                if field == "ticker":
+                    # tickers are mapped like the adapters map them when parsing
+                    values = [
+                        canonical(value, cusip, isin) if value else value
+                        for value, cusip, isin in zip(
+                            values, self.column("cusip"), self.column("isin")
+                        )
+                    ]
+            self.columns[field] = values
+        return self.columns[field]
+
+    def by_ticker(self):
+        # the first record listed for every ticker
+        records = {}
+        for record, ticker in zip(self, self.column("ticker")):
+            if ticker:
+                records.setdefault(ticker, record)
+        return records
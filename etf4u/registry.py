@@ -0,0 +1,234 @@
+import abc, logging, pkgutil, threading, time
+from contextlib import contextmanager
+
+import adapters
+from breaker import CircuitBreaker
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# Adapters declare, alongside the funds they support, how expensive and how parallel
+# their fetches can be, so the runner can schedule them sensibly: a single ARK .csv is
+# cheap, while Vanguard has to drive a whole Chrome instance and etfdb does several
+# requests per fund. Built-in adapters are the modules in the `adapters` folder,
+# third-party ones can be registered under the `etf4u.adapters` entry point group
+
+
+ENTRY_POINT_GROUP = "etf4u.adapters"
+FALLBACK_ADAPTER = "etfdb"
+
+
+class Adapter(abc.ABC):
+    name = None
+    # list of ETF symbols processed by this adapter
+    funds = []
+    # relative cost of fetching a single fund (1 being one small download)
+    cost = 1
+    # maximum number of funds fetched from the provider at the same time
+    max_concurrency = 4
+    # minimum amount of seconds between the start of two fetches from the provider
+    rate_limit = 0
+    # whether the adapter can fetch several funds with a single download
+    batch = False
+    # whether the adapter parses the provider's response while it is downloaded
+    streaming = False
+    # maximum amount of seconds a single fetch from the provider may take
+    timeout = None
+    # consecutive failures after which the provider is skipped for `cooldown` seconds
+    failure_threshold = 3
+    cooldown = 300
+
+    def __init__(self):
+        self.symbols = frozenset(fund.lower() for fund in self.funds)
+        self.semaphore = threading.BoundedSemaphore(max(1, self.max_concurrency))
+        self.rate_lock = threading.Lock()
+        self.last_fetch = 0
+        self.breaker = CircuitBreaker(self.name, self.failure_threshold, self.cooldown)
+
+    def supports(self, fund):
+        return fund.lower() in self.symbols
+
+    @abc.abstractmethod
+    def fetch(self, fund):
+        pass
+
+    def download(self, fund):
+        # adapters which can split fetching into downloading the provider's raw
+        # response and parsing it return that response here, so it can be cached
+        return None
+
+    def parse(self, content):
+        raise NotImplementedError(f"The {self.name} adapter can't parse raw responses")
+
+    def records(self, content):
+        # adapters which know the layout of their provider's raw responses return the
+        # full holdings records here (see records.Records), otherwise None
+        return None
+
+    def fetch_raw(self, fund):
+        # returns the holdings along with the raw response they were parsed from
+        content = self.download(fund)
+        if content is None:
+            return self.fetch(fund), None
+        return self.parse(content), content
+
+    async def fetch_raw_async(self, fund, session):
+        # adapters without an async implementation are fetched in a worker thread
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.fetch_raw, fund)
+
+    def fetch_many(self, funds):
+        # adapters with batch support override this to fetch several funds with fewer
+        # downloads, yielding (fund, holdings, raw response) for every fetched fund
+        for fund in funds:
+            yield (fund, *self.fetch_raw(fund))
+
+    @contextmanager
+    def slot(self):
+        # blocks until the provider's concurrency and rate limits allow another fetch
+        with self.semaphore:
+            if self.rate_limit:
+                with self.rate_lock:
+                    wait = self.last_fetch + self.rate_limit - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                    self.last_fetch = time.monotonic()
+            yield
+
+    def throttled_fetch(self, fund):
+        # raises CircuitOpenError straight away while the provider is being skipped
+        with self.breaker.guard(), self.slot():
+            return self.fetch_raw(fund)
+
+
+class ModuleAdapter(Adapter):
+    # wraps a bare adapter module exposing `FUNDS` and `fetch(fund)`, reading its
+    # capabilities from the optional upper-case module attributes
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+        self.funds = module.FUNDS
+        self.cost = getattr(module, "COST", Adapter.cost)
+        self.max_concurrency = getattr(
+            module, "MAX_CONCURRENCY", Adapter.max_concurrency
+        )
+        self.rate_limit = getattr(module, "RATE_LIMIT", Adapter.rate_limit)
+        self.batch = getattr(module, "BATCH", Adapter.batch)
+        self.streaming = getattr(module, "STREAMING", Adapter.streaming)
+        self.timeout = getattr(module, "TIMEOUT", Adapter.timeout)
+        self.failure_threshold = getattr(
+            module, "FAILURE_THRESHOLD", Adapter.failure_threshold
+        )
+        self.cooldown = getattr(module, "COOLDOWN", Adapter.cooldown)
+        super().__init__()
+
+    def fetch(self, fund):
+        return self.module.fetch(fund)
+
+    def download(self, fund):
+        if hasattr(self.module, "download") and hasattr(self.module, "parse"):
+            return self.module.download(fund)
+        return None
+
+    def parse(self, content):
+        if not hasattr(self.module, "parse"):
+            return super().parse(content)
+        return self.module.parse(content)
+
+    def records(self, content):
+        if hasattr(self.module, "records"):
+            return self.module.records(content)
+        return super().records(content)
+
+    async def fetch_raw_async(self, fund, session):
+        if hasattr(self.module, "download_async") and hasattr(self.module, "parse"):
+            content = await self.module.download_async(fund, session)
+            return self.module.parse(content), content
+        if hasattr(self.module, "fetch_async"):
+            return await self.module.fetch_async(fund, session), None
+        return await super().fetch_raw_async(fund, session)
+
+    def fetch_many(self, funds):
+        if hasattr(self.module, "download_many"):
+            for fund, content in self.module.download_many(funds):
+                try:
+                    yield fund, self.parse(content), content
+                except Exception as e:
+                    log.warning(f"Could not parse ETF {fund.upper()} in batch: {e}")
+        elif hasattr(self.module, "fetch_many"):
+            for fund, holdings in self.module.fetch_many(funds):
+                yield fund, holdings, None
+        else:
+            yield from super().fetch_many(funds)
+
+
+def load_entry_point(entry_point):
+    plugin = entry_point.load()
+    if isinstance(plugin, Adapter):
+        adapter = plugin
+    elif isinstance(plugin, type) and issubclass(plugin, Adapter):
+        adapter = plugin()
+    else:
+        adapter = ModuleAdapter(entry_point.name, plugin)
+    adapter.name = adapter.name or entry_point.name
+    return adapter
+
+
+def iter_entry_points(group=ENTRY_POINT_GROUP):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+    found = entry_points()
+    if hasattr(found, "select"):
+        return found.select(group=group)
+    return found.get(group, [])
+
+
+class Registry:
+    # built-in adapter modules are imported lazily, in the same order as they are found
+    # in the adapters folder, so funds from the first adapters never pay for importing
+    # the heavier dependencies of the later ones
+    def __init__(self):
+        self.adapters = {}
+        self.plugins = None
+        self.lock = threading.RLock()
+
+    def builtin(self, name):
+        with self.lock:
+            if name not in self.adapters:
+                for loader, module_name, _ in pkgutil.iter_modules(adapters.__path__):
+                    if module_name == name:
+                        module = loader.find_module(name).load_module(name)
+                        self.adapters[name] = ModuleAdapter(name, module)
+                        break
+            return self.adapters.get(name)
+
+    def load_plugins(self):
+        with self.lock:
+            if self.plugins is None:
+                self.plugins = []
+                for entry_point in iter_entry_points():
+                    try:
+                        self.plugins.append(load_entry_point(entry_point))
+                    except Exception as e:
+                        log.warning(f"Could not load adapter {entry_point.name}: {e}")
+            return self.plugins
+
+    def __iter__(self):
+        for _, name, _ in pkgutil.iter_modules(adapters.__path__):
+            yield self.builtin(name)
+        yield from self.load_plugins()
+
+    def find(self, fund):
+        for adapter in self:
+            if adapter.supports(fund):
+                return adapter
+        return None
+
+    def fallback(self):
+        return self.builtin(FALLBACK_ADAPTER)
+
+
+registry = Registry()
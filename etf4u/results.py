@@ -0,0 +1,67 @@
+import json, hashlib, logging
+
+from cache import CACHE_DIR, get_cached_file, read_cached, write_cached
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# Blends computed from funds cached today are cached as well, in the `.cache/results`
+# folder, named after a hash of everything the blend depends on: the version of every
+# constituent fund's cached holdings (its cache file's name, modification time and
+# size, so no file has to be read to check it) and all the blend options, including
+# the contents of the inclusion and exclusion lists. Running the same blend again reads
+# the stored result without fetching, merging or redistributing anything, and any
+# change to a fund's cached holdings (a new day, a --reparse...) changes the hash,
+# so outdated results are never used
+
+RESULTS_DIR = CACHE_DIR / "results"
+
+
+def fund_version(fund):
+    cached_file = get_cached_file(fund.lower())
+    try:
+        stat = cached_file.stat()
+    except FileNotFoundError:
+        return None
+    return [cached_file.name, stat.st_mtime_ns, stat.st_size]
+
+
+def get_result_key(
+    funds,
+    clamp=0,
+    minimum=0.0,
+    inclusion_list=None,
+    exclusion_list=None,
+    allocation=None,
+):
+    # None when any of the funds isn't cached for today
+    versions = [fund_version(fund) for fund in funds]
+    if None in versions:
+        return None
+    inputs = {
+        "funds": versions,
+        "clamp": clamp,
+        "minimum": minimum,
+        "include": sorted(inclusion_list or []),
+        "exclude": sorted(exclusion_list or []),
+    }
+    # the same allocation written with different scales (60/40, 0.6/0.4) is one blend
+    if allocation is not None:
+        total = sum(allocation)
+        inputs["allocation"] = [weight / total for weight in allocation]
+    return hashlib.sha256(json.dumps(inputs).encode("utf-8")).hexdigest()
+
+
+def get_result_file(key):
+    return RESULTS_DIR / f"{key}.csv.gz"
+
+
+def load_result(key):
+    result_file = get_result_file(key)
+    if not result_file.is_file():
+        return None
+    log.debug(f"Using blend result from cached file: {result_file}")
+    return dict(read_cached(result_file))
+
+
+def store_result(key, portfolio):
+    write_cached(get_result_file(key), portfolio)
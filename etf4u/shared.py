@@ -0,0 +1,180 @@
+import json, mmap, struct, logging
+from array import array
+from collections.abc import Mapping
+from datetime import datetime
+
+from cache import CACHE_DIR, file_lock, write_atomic
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# Several etf4u processes running on the same host can share the holdings they fetched
+# through a memory-mapped segment, one file per day in the `.cache/shared` folder,
+# instead of every process parsing the same cached .csv files into its own dictionaries.
+# A segment starts with a header and a JSON index of the funds it holds, followed by
+# the weights of every fund as an array of doubles and its tickers as a blob of
+# newline-separated symbols. Processes attach to the segment read-only, weights are
+# read straight from the mapped memory and tickers are decoded the first time a fund
+# is used, so the pages of the segment are shared by all processes through the page
+# cache no matter how many of them are running. Publishing funds writes a new segment
+# (merged with the funds already published that day) and moves it in place, processes
+# attached to the previous one keep reading it until they attach again
+
+SHARED_DIR = CACHE_DIR / "shared"
+MAGIC = b"ETF4USHM"
+VERSION = 1
+# magic, version and length of the JSON index
+HEADER = struct.Struct("<8sII")
+
+# segments attached by this process, keyed on the file's path, modification time and
+# size, so that a segment replaced by another process is attached again
+_segments = {}
+
+
+def get_segment_file(now=None):
+    now = now or datetime.now()
+    return SHARED_DIR / f"holdings_{now.strftime('%Y%m%d')}.bin"
+
+
+def align(offset, size=8):
+    return offset + -offset % size
+
+
+class SharedHoldings(Mapping):
+    # a fund's read-only holdings, backed by the weights and tickers of a segment
+    __slots__ = ("path", "fund", "weights", "blob", "_tickers", "_positions")
+    stale = False
+    fallback = False
+
+    def __init__(self, path, fund, weights, blob):
+        self.path = path
+        self.fund = fund
+        self.weights = weights
+        self.blob = blob
+        self._tickers = None
+        self._positions = None
+
+    @property
+    def tickers(self):
+        if self._tickers is None:
+            self._tickers = str(self.blob, "utf-8").split("\n") if self.blob else []
+        return self._tickers
+
+    def __getitem__(self, ticker):
+        if self._positions is None:
+            self._positions = {t: i for i, t in enumerate(self.tickers)}
+        return self.weights[self._positions[ticker]]
+
+    def __iter__(self):
+        return iter(self.tickers)
+
+    def __len__(self):
+        return len(self.weights)
+
+    def items(self):
+        return zip(self.tickers, self.weights)
+
+    def values(self):
+        return iter(self.weights)
+
+    def __reduce__(self):
+        # worker processes receiving the holdings attach to the same segment rather
+        # than getting a copy of them
+        return (lookup, (self.path, self.fund))
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_length = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a shared holdings segment")
+        start = HEADER.size
+        self.index = json.loads(self.buffer[start : start + index_length])
+        self.data_start = align(start + index_length)
+        self.funds = {}
+
+    def get(self, fund):
+        if fund not in self.funds and fund in self.index:
+            weights_offset, count, tickers_offset, tickers_length = self.index[fund]
+            view = memoryview(self.buffer)
+            start = self.data_start + weights_offset
+            weights = view[start : start + count * 8].cast("d")
+            start = self.data_start + tickers_offset
+            blob = view[start : start + tickers_length]
+            self.funds[fund] = SharedHoldings(self.path, fund, weights, blob)
+        return self.funds.get(fund)
+
+
+def attach(path=None):
+    path = path or get_segment_file()
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    segment = _segments.get(key)
+    if segment is None:
+        log.debug(f"Attaching to shared holdings segment: {path}")
+        segment = Segment(path)
+        for stale_key in [k for k in _segments if k[0] == key[0]]:
+            del _segments[stale_key]
+        _segments[key] = segment
+    return segment
+
+
+def lookup(path, fund):
+    segment = attach(path)
+    holdings = segment.get(fund) if segment else None
+    if holdings is None:
+        raise KeyError(f"{fund.upper()} is not in the shared holdings segment {path}")
+    return holdings
+
+
+def find_shared(funds):
+    # the funds of the list already published in today's segment
+    segment = attach()
+    if segment is None:
+        return {}
+    return {fund: segment.get(fund) for fund in funds if fund in segment.index}
+
+
+def write_segment(path, holdings):
+    index, weights, blobs = {}, [], []
+    weights_length = sum(len(data) for data in holdings.values()) * 8
+    weights_offset, tickers_offset = 0, weights_length
+    for fund, data in holdings.items():
+        blob = "\n".join(data.keys()).encode("utf-8")
+        index[fund] = [weights_offset, len(data), tickers_offset, len(blob)]
+        weights.append(array("d", data.values()))
+        blobs.append(blob)
+        weights_offset += len(data) * 8
+        tickers_offset += len(blob)
+
+    index = json.dumps(index).encode("utf-8")
+    padding = align(HEADER.size + len(index)) - HEADER.size - len(index)
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(index)))
+        f.write(index + b"\0" * padding)
+        for fund_weights in weights:
+            fund_weights.tofile(f)
+        for blob in blobs:
+            f.write(blob)
+
+
+def publish(holdings):
+    # adds the funds to today's segment, keeping the ones published by other processes
+    if not holdings:
+        return
+    path = get_segment_file()
+    with file_lock(SHARED_DIR / ".lock"):
+        segment = attach(path)
+        published = {}
+        if segment:
+            for fund in segment.index:
+                if fund not in holdings:
+                    published[fund] = dict(segment.get(fund).items())
+        published.update(holdings)
+        log.debug(f"Publishing {len(holdings)} funds to shared segment: {path}")
+        write_atomic(path, lambda temp_file: write_segment(temp_file, published))
@@ -0,0 +1,74 @@
+import csv, re, logging
+from pathlib import Path
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# Providers don't write the same security the same way: a share class can be listed as
+# BRK.B, BRK/B, BRK B or BRKB depending on the fund, so blending them would keep them
+# as separate holdings. Adapters map every ticker they parse to a canonical one, looking
+# up the security's identifiers (CUSIP, ISIN) first when their files list them, then
+# the ticker itself. Tickers made of a base and a single share class letter are written
+# as BASE.CLASS, and the index maps any other known variant (like BRKB) to its canonical
+# ticker. The index is read from `tickers.csv` next to this module, and can be extended
+# with other files of the same format: every row holds a canonical ticker followed by
+# its aliases. Resolved tickers are memoized, so parsing only pays for a dict lookup
+
+INDEX_FILE = Path(__file__).parent / "tickers.csv"
+SHARE_CLASS = re.compile(r"^([A-Z]{1,5})[./\- ]([A-Z])$")
+
+_index = {}
+_resolved = {}
+# the files the index was read from, as (path, modification time, size)
+_sources = []
+
+
+def normalize(ticker):
+    ticker = ticker.strip().upper()
+    match = SHARE_CLASS.match(ticker)
+    return f"{match[1]}.{match[2]}" if match else ticker
+
+
+def read_aliases(path, index):
+    log.debug(f"Loading ticker aliases from file: {path}")
+    stat = Path(path).stat()
+    _sources.append((str(Path(path).resolve()), stat.st_mtime_ns, stat.st_size))
+    with open(path, "r", newline="") as csv_file:
+        for row in csv.reader(csv_file):
+            if not row or not row[0].strip():
+                continue
+            canonical_ticker = normalize(row[0])
+            for alias in row:
+                if alias.strip():
+                    index[normalize(alias)] = canonical_ticker
+
+
+def get_index():
+    if not _index:
+        read_aliases(INDEX_FILE, _index)
+    return _index
+
+
+def index_version():
+    # identifies the aliases the index holds, for anything caching canonical tickers
+    get_index()
+    return list(_sources)
+
+
+def load_index(path):
+    # extends the index with the aliases of another file
+    read_aliases(path, get_index())
+    _resolved.clear()
+
+
+def canonical(ticker, *identifiers):
+    index = get_index()
+    for identifier in identifiers:
+        if identifier:
+            canonical_ticker = index.get(identifier.strip().upper())
+            if canonical_ticker:
+                return canonical_ticker
+    resolved = _resolved.get(ticker)
+    if resolved is None:
+        normalized = normalize(ticker)
+        resolved = _resolved[ticker] = index.get(normalized, normalized)
+    return resolved
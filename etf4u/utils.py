@@ -1,3 +1,93 @@
+import http.client, urllib.parse, urllib.error, urllib.request, logging
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.77 Safari/537.36"
 }
+
+
+class Session:
+    # keeps a single keep-alive connection open for each host, so adapters downloading
+    # several files from the same provider only pay for the connection setup once
+    def __init__(self, timeout=None, max_redirects=5):
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.connections = {}
+
+    def connect(self, scheme, host):
+        key = (scheme, host)
+        if key not in self.connections:
+            connection_class = (
+                http.client.HTTPSConnection
+                if scheme == "https"
+                else http.client.HTTPConnection
+            )
+            self.connections[key] = connection_class(host, timeout=self.timeout)
+        return self.connections[key]
+
+    def get(self, url):
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path + (f"?{parts.query}" if parts.query else "")
+            # a kept-alive connection might have been closed by the server in the
+            # meantime, in which case the request is retried once on a new one
+            for attempt in range(2):
+                connection = self.connect(parts.scheme, parts.netloc)
+                try:
+                    connection.request("GET", path, headers=HEADERS)
+                    res = connection.getresponse()
+                    body = res.read()
+                    break
+                except (http.client.HTTPException, ConnectionError):
+                    connection.close()
+                    del self.connections[(parts.scheme, parts.netloc)]
+                    if attempt:
+                        raise
+            if res.status in (301, 302, 303, 307, 308) and res.getheader("Location"):
+                url = urllib.parse.urljoin(url, res.getheader("Location"))
+                continue
+            if res.status >= 400:
+                raise urllib.error.HTTPError(url, res.status, res.reason, res.msg, None)
+            return body
+        raise urllib.error.URLError(f"Too many redirects fetching {url}")
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def download_csv(url, timeout=None):
+    req = urllib.request.Request(url, headers=HEADERS)
+    with urllib.request.urlopen(req, timeout=timeout) as res:
+        return res.read()
+
+
+def csv_downloads(get_fund_file, timeout=None):
+    # the download functions of adapters fetching a single file per fund, found at the
+    # url `get_fund_file` returns: `download(fund)`, `download_async(fund, session)`
+    # and `download_many(funds)`, which downloads the files of several funds over the
+    # same connection
+
+    def download(fund):
+        return download_csv(get_fund_file(fund), timeout)
+
+    async def download_async(fund, session):
+        return await session.get(get_fund_file(fund), timeout=timeout)
+
+    def download_many(funds):
+        with Session(timeout=timeout) as session:
+            for fund in funds:
+                try:
+                    yield fund, session.get(get_fund_file(fund))
+                except Exception as e:
+                    log.warning(f"Could not fetch ETF {fund.upper()} in batch: {e}")
+
+    return download, download_async, download_many
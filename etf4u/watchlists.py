@@ -0,0 +1,72 @@
+import os, json, hashlib, logging
+from pathlib import Path
+
+from cache import CACHE_DIR, write_atomic
+from tickers import canonical, index_version
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# Inclusion / exclusion lists can be passed either as tickers on the command line or as
+# the path to a text file of whitespace-separated tickers. Those files can hold tens of
+# thousands of symbols, so they are read line by line into a frozenset (O(1) membership
+# tests while filtering). Like the holdings of the funds, the tickers of the lists are
+# mapped to their canonical tickers (so BRKB or BRK/B in a list matches the BRK.B
+# holding), which is why any other ticker aliases have to be loaded before the lists
+# are. The compiled list, one canonical ticker per line, is stored in the
+# `.cache/lists` folder, keyed on the file's path, modification time and size (and on
+# the ticker aliases used), so later runs using the same list only read it back, and is
+# kept in memory for the other blends of the same process. The batch mode compiles the
+# lists of all its blends up front and hands the sets to its worker processes
+
+LISTS_DIR = CACHE_DIR / "lists"
+
+_compiled_lists = {}
+
+
+def read_tickers(path):
+    with open(path, "r") as f:
+        for line in f:
+            for ticker in line.split():
+                yield canonical(ticker)
+
+
+def digest(value):
+    return hashlib.sha256(json.dumps(value).encode("utf-8")).hexdigest()[:16]
+
+
+def load_tickers_file(path):
+    path = Path(path).resolve()
+    stat = path.stat()
+    key = [str(path), stat.st_mtime_ns, stat.st_size, index_version()]
+    # compiled versions of the same file share a prefix, so outdated ones are found
+    prefix = digest(str(path))
+    compiled_file = LISTS_DIR / f"{prefix}_{digest(key)}.txt"
+    tickers = _compiled_lists.get(compiled_file)
+    if tickers is not None:
+        return tickers
+
+    if compiled_file.is_file():
+        log.debug(f"Using compiled tickers list from cached file: {compiled_file}")
+        tickers = frozenset(compiled_file.read_text().split())
+    else:
+        log.debug(f"Compiling tickers list from file: {path}")
+        tickers = frozenset(read_tickers(path))
+        for stale_file in LISTS_DIR.glob(f"{prefix}_*.txt"):
+            try:
+                stale_file.unlink()
+            except FileNotFoundError:
+                # removed by another process at the same time
+                pass
+        write_atomic(compiled_file, lambda temp: temp.write_text("\n".join(tickers)))
+    _compiled_lists[compiled_file] = tickers
+    return tickers
+
+
+def load_tickers(values):
+    # mirrors the command line arguments: if the first value points to a file, the list
+    # is read from that file, otherwise the values themselves are the tickers
+    if not values:
+        return frozenset()
+    if os.path.isfile(values[0]):
+        return load_tickers_file(values[0])
+    return frozenset(canonical(value) for value in values)
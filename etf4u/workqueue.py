@@ -0,0 +1,318 @@
+import abc, os, time, socket, sqlite3, logging, threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+
+from breaker import CircuitOpenError
+from cache import query
+from funds import find_adapter
+from registry import iter_entry_points
+
+log = logging.getLogger(f"etf4u.{__name__}")
+
+# Refreshing hundreds of funds from a single host is slow, and runs into the providers'
+# per-address throttling. A work queue lets workers on several hosts share the load:
+# the funds to fetch are put on the queue, and every worker leases one fund at a time,
+# fetches it and writes it to the cache, which is shared by running all the workers
+# (and the blends using their results) from the same directory on a shared file
+# system - the cache files are already locked and written atomically. A lease expires
+# if its worker doesn't renew it in time (because it crashed or lost its connection),
+# and the fund is then leased again, failed fetches being retried up to a maximum number
+# of attempts after an exponentially growing delay. Funds of a provider whose circuit
+# breaker is open are put back on the queue until its cool-down is over. The queue
+# included here is a SQLite database, other backends can be registered under the
+# `etf4u.queues` entry point group: a WorkQueue subclass, created with the location of
+# the queue (the part of its URL following `<name>://`)
+
+QUEUES_ENTRY_POINT_GROUP = "etf4u.queues"
+# seconds a worker holds a fund for, renewed while it's being fetched
+LEASE_DURATION = 300
+# seconds before a failed fetch is retried, doubled after every attempt
+RETRY_DELAY = 30
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+
+class WorkQueue(abc.ABC):
+    # number of times a fund is fetched before giving up on it
+    max_attempts = 3
+    retry_delay = RETRY_DELAY
+
+    @abc.abstractmethod
+    def put(self, funds):
+        # adds the funds to the queue, fetching again the ones already fetched
+        pass
+
+    @abc.abstractmethod
+    def lease(self, worker, duration=LEASE_DURATION):
+        # the next fund to fetch, now leased to the worker, or None
+        pass
+
+    @abc.abstractmethod
+    def renew(self, fund, worker, duration=LEASE_DURATION):
+        # whether the worker still holds the lease on the fund
+        pass
+
+    @abc.abstractmethod
+    def complete(self, fund, worker):
+        pass
+
+    @abc.abstractmethod
+    def fail(self, fund, worker, error):
+        # the fund is leased again after `retry_delay` seconds, doubled after every
+        # attempt, until it's out of attempts
+        pass
+
+    @abc.abstractmethod
+    def release(self, fund, worker, delay=0):
+        # gives the fund back without counting the attempt, to be leased again after
+        # `delay` seconds
+        pass
+
+    @abc.abstractmethod
+    def progress(self):
+        # the number of funds in every state
+        pass
+
+    def failures(self):
+        # the funds given up on, along with the error of their last attempt
+        return []
+
+
+class SQLiteQueue(WorkQueue):
+    # every operation uses its own connection, so the queue can be shared by threads
+    # as well as processes, leases are taken in an immediate transaction to be atomic.
+    # Lease expiry relies on the clocks of the hosts being in sync
+    def __init__(
+        self,
+        path,
+        max_attempts=WorkQueue.max_attempts,
+        retry_delay=WorkQueue.retry_delay,
+    ):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        with self.transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "fund TEXT PRIMARY KEY, state TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, "
+                "lease_expires REAL, error TEXT, not_before REAL)"
+            )
+            # queues created before retries were delayed lack the column
+            columns = [row[1] for row in db.execute("PRAGMA table_info(jobs)")]
+            if "not_before" not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN not_before REAL")
+
+    @contextmanager
+    def transaction(self):
+        with closing(
+            sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        ) as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def put(self, funds):
+        with self.transaction() as db:
+            db.executemany(
+                "INSERT INTO jobs (fund, state) VALUES (?, ?) "
+                "ON CONFLICT (fund) DO UPDATE SET state = excluded.state, "
+                "attempts = 0, error = NULL, not_before = NULL WHERE state != ?",
+                [(fund.lower(), PENDING, LEASED) for fund in funds],
+            )
+
+    def lease(self, worker, duration=LEASE_DURATION):
+        now = time.time()
+        with self.transaction() as db:
+            # expired leases of funds out of attempts aren't given another chance
+            db.execute(
+                "UPDATE jobs SET state = ?, error = 'lease expired' "
+                "WHERE state = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, LEASED, now, self.max_attempts),
+            )
+            row = db.execute(
+                "SELECT fund FROM jobs "
+                "WHERE (state = ? AND (not_before IS NULL OR not_before <= ?)) "
+                "OR (state = ? AND lease_expires < ?) "
+                "ORDER BY attempts, rowid LIMIT 1",
+                (PENDING, now, LEASED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET state = ?, worker = ?, lease_expires = ?, "
+                "attempts = attempts + 1 WHERE fund = ?",
+                (LEASED, worker, now + duration, row[0]),
+            )
+        return row[0]
+
+    def renew(self, fund, worker, duration=LEASE_DURATION):
+        with self.transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET lease_expires = ? "
+                "WHERE fund = ? AND worker = ? AND state = ?",
+                (time.time() + duration, fund, worker, LEASED),
+            )
+        return cursor.rowcount > 0
+
+    def complete(self, fund, worker):
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE jobs SET state = ?, lease_expires = NULL, error = NULL "
+                "WHERE fund = ? AND worker = ? AND state = ?",
+                (DONE, fund, worker, LEASED),
+            )
+
+    def fail(self, fund, worker, error):
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                "lease_expires = NULL, error = ?, "
+                "not_before = ? + ? * (1 << (attempts - 1)) "
+                "WHERE fund = ? AND worker = ? AND state = ?",
+                (
+                    self.max_attempts,
+                    FAILED,
+                    PENDING,
+                    error,
+                    time.time(),
+                    self.retry_delay,
+                    fund,
+                    worker,
+                    LEASED,
+                ),
+            )
+
+    def release(self, fund, worker, delay=0):
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE jobs SET state = ?, lease_expires = NULL, not_before = ?, "
+                "attempts = attempts - 1 WHERE fund = ? AND worker = ? AND state = ?",
+                (PENDING, time.time() + delay, fund, worker, LEASED),
+            )
+
+    def progress(self):
+        with self.transaction() as db:
+            rows = db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")
+            return dict(rows.fetchall())
+
+    def failures(self):
+        with self.transaction() as db:
+            rows = db.execute("SELECT fund, error FROM jobs WHERE state = ?", (FAILED,))
+            return rows.fetchall()
+
+
+def open_queue(url):
+    # either the path of a SQLite database, or `<backend>://<location>`
+    backend, _, location = url.partition("://")
+    if not location:
+        return SQLiteQueue(url)
+    if backend == "sqlite":
+        return SQLiteQueue(location)
+    for entry_point in iter_entry_points(QUEUES_ENTRY_POINT_GROUP):
+        if entry_point.name == backend:
+            return entry_point.load()(location)
+    raise ValueError(f"Unknown work queue backend: {backend}")
+
+
+def describe(progress):
+    total = sum(progress.values())
+    return (
+        f"{progress.get(DONE, 0)}/{total} funds fetched, "
+        f"{progress.get(LEASED, 0)} in progress, {progress.get(FAILED, 0)} failed"
+    )
+
+
+def fetch(fund, adapter):
+    # unlike fetch_fund(), funds of unavailable providers don't fall back to the cache
+    # or another adapter, since the point of fetching them is updating the cache
+    log.info(f"Fetching ETF {fund.upper()} using {adapter.name} adapter")
+    return query(fund, adapter.throttled_fetch)
+
+
+def keep_leased(queue, fund, worker, duration, stop):
+    while not stop.wait(duration / 3):
+        if not queue.renew(fund, worker, duration):
+            log.warning(f"Lost the lease on ETF {fund.upper()}")
+            return
+
+
+def work(queue, worker, duration=LEASE_DURATION, poll=5):
+    # fetches funds from the queue until there's none left, waiting on the funds leased
+    # by other workers as long as their leases might expire, and on the funds waiting
+    # to be retried
+    fetched = 0
+    while True:
+        fund = queue.lease(worker, duration)
+        if fund is None:
+            progress = queue.progress()
+            if not progress.get(LEASED) and not progress.get(PENDING):
+                return fetched
+            time.sleep(poll)
+            continue
+
+        # funds of a provider which is unavailable wait for the end of its cool-down
+        # rather than being leased over and over again
+        adapter = find_adapter(fund)
+        retry_after = adapter.breaker.retry_after()
+        if retry_after:
+            log.debug(
+                f"The {adapter.name} adapter is unavailable, deferring ETF {fund}"
+            )
+            queue.release(fund, worker, retry_after)
+            continue
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(
+            target=keep_leased, args=(queue, fund, worker, duration, stop), daemon=True
+        )
+        heartbeat.start()
+        try:
+            if not fetch(fund, adapter):
+                raise ValueError("no holdings found")
+        except CircuitOpenError as e:
+            # another worker (or host) can fetch it, or this one once the provider
+            # is available again
+            log.info(f"{e}, giving ETF {fund.upper()} back to the queue")
+            queue.release(fund, worker, max(adapter.breaker.retry_after(), poll))
+        except Exception as e:
+            log.warning(f"Could not fetch ETF {fund.upper()}: {e}")
+            queue.fail(fund, worker, str(e))
+        else:
+            queue.complete(fund, worker)
+            fetched += 1
+        finally:
+            stop.set()
+            heartbeat.join()
+        log.info(describe(queue.progress()))
+
+
+def run_workers(queue, workers=4, duration=LEASE_DURATION):
+    # every host runs several workers, the adapters' concurrency and rate limits
+    # still applying to all the workers of the host
+    name = f"{socket.gethostname()}-{os.getpid()}"
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        fetched = sum(
+            executor.map(
+                lambda i: work(queue, f"{name}-{i}", duration),
+                range(workers),
+            )
+        )
+    log.info(f"Fetched {fetched} funds from the queue")
+    return fetched
+
+
+def report_progress(queue, interval=10):
+    # waits until every fund in the queue has been either fetched or given up on
+    while True:
+        progress = queue.progress()
+        log.info(describe(progress))
+        if not progress.get(PENDING) and not progress.get(LEASED):
+            for fund, error in queue.failures():
+                log.warning(f"Gave up on fetching ETF {fund.upper()}: {error}")
+            return progress
+        time.sleep(interval)